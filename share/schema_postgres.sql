@@ -22,3 +22,33 @@ CREATE TABLE tilde_home_state (
     ts              TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
     UNIQUE (id, server_name)
 );
+
+CREATE FUNCTION tilde_touch() RETURNS trigger AS $$
+BEGIN
+    NEW.ts := NOW();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tilde_home_touch
+    BEFORE INSERT OR UPDATE ON tilde_home
+    FOR EACH ROW EXECUTE PROCEDURE tilde_touch();
+
+CREATE TRIGGER tilde_home_state_touch
+    BEFORE INSERT OR UPDATE ON tilde_home_state
+    FOR EACH ROW EXECUTE PROCEDURE tilde_touch();
+
+CREATE FUNCTION tilde_home_notify() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('tilde_home', OLD.id::text);
+        RETURN OLD;
+    END IF;
+    PERFORM pg_notify('tilde_home', NEW.id::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tilde_home_notify
+    AFTER INSERT OR UPDATE OR DELETE ON tilde_home
+    FOR EACH ROW EXECUTE PROCEDURE tilde_home_notify();
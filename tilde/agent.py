@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+# (C) Copyright Révolution Linux 2012
+#
+# Authors:
+# Vincent Vinet <vince.vinet@gmail.com>
+#
+# This file is part of tilde.
+#
+# tilde is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tilde is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tilde.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import inspect
+import itertools
+import json
+import logging
+log = logging.getLogger(__name__)
+
+from twisted.internet import defer
+from twisted.protocols.basic import LineOnlyReceiver
+
+from tilde import helper
+from tilde.ssh import CommandTimeout, RemoteCommandProtocol
+
+
+class AgentUnavailable(Exception):
+    """ The helper agent can't serve a request, use the usual command """
+
+class AgentError(Exception):
+    """ The helper agent failed to do what was requested """
+
+
+def helper_source():
+    """ Source of the helper agent, without its leading comments """
+    lines = inspect.getsource(helper).splitlines(True)
+    while lines and lines[0].startswith("#"):
+        lines.pop(0)
+    return "".join(lines).encode("ascii")
+
+# Read once, while the helper's module path is still valid
+HELPER_SOURCE = helper_source()
+
+
+class AgentProtocol(LineOnlyReceiver, RemoteCommandProtocol):
+    """ Talks to a helper agent started by the C{agent} command
+
+    The command is expected to read the length of the helper's source on
+    a line, then the source, and run it. Requests sent before the channel
+    is open are held until it is.
+
+    The agent does one request at a time, when one takes longer than its
+    timeout the agent is stopped, the requests behind it would wait as
+    long.
+    """
+    delimiter = "\n"
+
+    def __init__(self, source=None, clock=None):
+        self.source = HELPER_SOURCE if source is None else source
+        self.ready = False
+        self.lost = False
+        self._pending = {}
+        self._timeouts = {}
+        self._held = []
+        self._ids = itertools.count(1)
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        # When the agent last answered, None until it started
+        self.lastActive = None
+
+    def connectionMade(self):
+        self.lastActive = self.clock.seconds()
+        self.transport.write("{0}\n{1}".format(len(self.source), self.source))
+        held, self._held = self._held, []
+        for id, line, timeout in held:
+            self._send(id, line, timeout)
+
+    def request(self, op, timeout=None, **args):
+        """ Send a request to the agent
+
+        @param timeout: seconds after which the request fails with
+            L{CommandTimeout}, and the agent is stopped
+        @return: a C{Deferred} firing with the result, failing with
+            L{AgentUnavailable} if the agent is gone or can't do it
+        """
+        if self.lost:
+            return defer.fail(AgentUnavailable("Agent is not running"))
+
+        id = next(self._ids)
+        d = self._pending[id] = defer.Deferred()
+        line = json.dumps({"id": id, "op": op, "args": args})
+        if self.transport is None:
+            self._held.append((id, line, timeout))
+        else:
+            self._send(id, line, timeout)
+        return d
+
+    def idleSince(self):
+        """ When the agent last answered, or C{None} if it is busy """
+        if self._pending:
+            return None
+        return self.lastActive
+
+    def stop(self):
+        """ Stop the agent, failing the requests not answered yet """
+        if self.transport is not None:
+            self.transport.loseConnection()
+        self._lost()
+
+    def _send(self, id, line, timeout):
+        self.sendLine(line)
+        if timeout:
+            self._timeouts[id] = self.clock.callLater(
+                timeout, self._timedOut, id, timeout)
+
+    def _timedOut(self, id, timeout):
+        del self._timeouts[id]
+        d = self._pending.pop(id)
+        log.warning("Stopping the agent, a request took more than %ss",
+                    timeout)
+        d.errback(CommandTimeout(
+            "Agent request timed out after {0}s".format(timeout)))
+        self.stop()
+
+    def lineReceived(self, line):
+        if not self.ready and line == "ready":
+            self.ready = True
+            return
+
+        try:
+            response = json.loads(line)
+            d = self._pending.pop(response["id"])
+        except (ValueError, KeyError, TypeError):
+            log.warning("Unexpected line from agent: %r", line)
+            return
+
+        self.lastActive = self.clock.seconds()
+        call = self._timeouts.pop(response["id"], None)
+        if call is not None:
+            call.cancel()
+
+        if "error" not in response:
+            d.callback(response.get("result"))
+        elif response.get("fallback"):
+            d.errback(AgentUnavailable(response["error"]))
+        else:
+            d.errback(AgentError(response["error"]))
+
+    def commandExited(self, reason):
+        RemoteCommandProtocol.commandExited(self, reason)
+        self._lost()
+
+    def connectionLost(self, reason):
+        RemoteCommandProtocol.connectionLost(self, reason)
+        self._lost()
+
+    def _lost(self):
+        self.lost = True
+        timeouts, self._timeouts = self._timeouts, {}
+        for call in timeouts.itervalues():
+            call.cancel()
+        pending, self._pending = self._pending, {}
+        for d in pending.itervalues():
+            d.errback(AgentUnavailable("Agent stopped"))
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+# (C) Copyright Révolution Linux 2012
+#
+# Authors:
+# Vincent Vinet <vince.vinet@gmail.com>
+#
+# This file is part of tilde.
+#
+# tilde is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tilde is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tilde.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import collections
+import logging
+log = logging.getLogger(__name__)
+
+
+class HomeCache(object):
+    """ Keeps up to C{size} homes in memory, by id and by uuid
+
+    The least recently used homes are dropped first. Homes read from the
+    database are only stored if nothing was invalidated since the read
+    started, see L{token}, so a slow read can't put back an outdated home.
+
+    Several homes may share a uuid, a lookup by uuid is only answered with
+    the complete list of homes read for it, see L{putUUID}.
+    """
+
+    def __init__(self, size=10000):
+        self.size = max(size, 1)
+        self._homes = collections.OrderedDict()
+        # Ids of the homes found for each uuid, all of them in _homes
+        self._uuids = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._homes)
+
+    def token(self):
+        """ Get a token to pass to L{put} for a read starting now """
+        return self._generation
+
+    def get(self, id):
+        """ Get a copy of the home with C{id}, or C{None} if not cached """
+        home = self._homes.pop(id, None)
+        if home is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._homes[id] = home
+        return home.copy()
+
+    def getByUUID(self, uuid):
+        """ Get copies of the homes with C{uuid}, or C{None} if not cached """
+        ids = self._uuids.get(uuid)
+        if ids is None:
+            self.misses += 1
+            return None
+        return [self.get(id) for id in ids]
+
+    def put(self, home, token=None):
+        """ Cache a copy of C{home}, unless invalidated since C{token} """
+        if token is not None and token != self._generation:
+            return
+        self._discard(home.id)
+        ids = self._uuids.get(home.uuid)
+        if ids is not None and home.id not in ids:
+            # One more home for that uuid
+            del self._uuids[home.uuid]
+        self._homes[home.id] = home.copy()
+        while len(self._homes) > self.size:
+            id, old = self._homes.popitem(last=False)
+            self._uuids.pop(old.uuid, None)
+
+    def putUUID(self, uuid, homes, token=None):
+        """ Cache C{homes}, all the homes found with C{uuid} """
+        if token is not None and token != self._generation:
+            return
+        for home in homes:
+            self.put(home)
+        if homes and all(home.id in self._homes for home in homes):
+            self._uuids[uuid] = tuple(home.id for home in homes)
+
+    def invalidate(self, id, uuids=False):
+        """ Drop home C{id}
+
+        @param uuids: the change may have given the home a uuid, as a new
+            home would, all lookups by uuid are dropped too
+        """
+        self._generation += 1
+        self._discard(id)
+        if uuids:
+            self._uuids.clear()
+
+    def clear(self):
+        self._generation += 1
+        self._homes.clear()
+        self._uuids.clear()
+
+    def _discard(self, id):
+        old = self._homes.pop(id, None)
+        if old is not None:
+            self._uuids.pop(old.uuid, None)
@@ -50,19 +50,40 @@ class Commands(dict):
         for k, v in kw.iteritems():
             setattr(self, k, v)
 
+    def __setattr__(self, name, value):
+        # <command>_timeout is the default timeout of a command, in seconds
+        if name.endswith("_timeout"):
+            self[name] = float(value) if value else None
+        else:
+            dict.__setattr__(self, name, value)
+
     def copy(self):
         return Commands(**self)
 
+    def timeout(self, name):
+        """ Seconds after which the C{name} command is killed, or C{None} """
+        return self.get(name + "_timeout")
+
     stat = check_format("stat", "path")
+    stat_many = check_format("stat_many")
     test = check_format("test", "path")
     mkdir = check_format("mkdir", "path")
     move = check_format("move", "src_path", "dst_path")
     mkhome = check_format("mkhome", "path", "owner", "group")
     sync = check_format("sync", "src_path", "dst", "dst_path")
     chown_ref = check_format("chown_ref", "path", "ref")
+    agent = check_format("agent")
 
 ubuntu = Commands(
     stat="/usr/bin/stat -c%F:%U:%G:%a '{path}'",
+    # Reads one path per line, answers one ok:<stat>, missing or error line
+    stat_many=" ".join((
+        "while IFS= read -r p; do",
+        "if [ ! -e \"$p\" ] && [ ! -L \"$p\" ]; then echo missing;",
+        "else /usr/bin/stat -c ok:%F:%U:%G:%a -- \"$p\" 2>/dev/null",
+        "|| echo error; fi;",
+        "done",
+    )),
     test="/usr/bin/test -e '{path}'",
     mkdir="/bin/mkdir -p '{path}'",
     move="/bin/mv -T --backup=t '{src_path}' '{dst_path}'",
@@ -71,6 +92,19 @@ ubuntu = Commands(
         "/bin/chown '{owner}':'{group}' '{path}'",
         "/bin/chmod 750 '{path}'",
     )),
-    sync="/usr/bin/rsync -rlptgoA '{src_path}/' '{dst}:{dst_path}'",
-    chown_ref="/bin/chown --reference='{ref}' -R '{path}'"
+    # Add --info=progress2 to follow running syncs, with rsync 3.1 or later
+    sync="/usr/bin/rsync -rlptgoA --stats '{src_path}/' '{dst}:{dst_path}'",
+    chown_ref="/bin/chown --reference='{ref}' -R '{path}'",
+    stat_timeout=60,
+    stat_many_timeout=600,
+    test_timeout=60,
+    mkdir_timeout=60,
+    mkhome_timeout=60,
+    # Moves within a share are renames, across devices they copy
+    move_timeout=3600,
+    # Reads the length of the helper agent's source, then the source
+    agent=" ".join((
+        "/usr/bin/python3 -u -c",
+        "\"import sys; exec(sys.stdin.read(int(sys.stdin.readline())))\"",
+    )),
 )
@@ -20,30 +20,134 @@
 # You should have received a copy of the GNU General Public License
 # along with tilde.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import os
+import random
+import re
 
 import logging
 log = logging.getLogger(__name__)
 
 from tilde.util import log_err
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.internet.error import ProcessTerminated
+from twisted.python.failure import Failure
 
 from tilde import models
-from tilde.ssh import SSHServer, RunCommandProtocol
+from tilde.ssh import (
+    SSHServerPool,
+    RemoteCommandProtocol,
+    RunCommandProtocol,
+    InputCommandProtocol,
+)
 from tilde.commands import ubuntu
+from tilde.agent import AgentProtocol, AgentUnavailable, AgentError
+
+
+RSYNC_TRANSFERRED = re.compile(
+    r"^Total transferred file size: ([\d,.]+) bytes", re.MULTILINE)
+
+
+def rsync_transferred(output):
+    """ Bytes copied according to rsync's --stats C{output}, or C{None} """
+    match = RSYNC_TRANSFERRED.search(output)
+    if match is None:
+        return None
+    return int(re.sub(r"\D", "", match.group(1)))
+
+
+# rsync --info=progress2 lines: bytes, percent, rate and time left
+RSYNC_PROGRESS = re.compile(
+    r"^\s*([\d,]+)\s+(\d+)%\s+([\d.]+)([kMGT]?)B/s\s+(\d+):(\d\d):(\d\d)")
+RATE_UNITS = {"": 1, "k": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def rsync_progress(line):
+    """ Parse an rsync progress C{line}
+
+    @return: a C{dict} with the bytes copied, percent done, rate in bytes
+        per second and eta in seconds, or C{None}
+    """
+    match = RSYNC_PROGRESS.match(line)
+    if match is None:
+        return None
+    copied, percent, rate, unit, hours, minutes, seconds = match.groups()
+    return {
+        "bytes": int(copied.replace(",", "")),
+        "percent": int(percent),
+        "rate": int(float(rate) * RATE_UNITS[unit]),
+        "eta": int(hours) * 3600 + int(minutes) * 60 + int(seconds),
+    }
+
+
+class RsyncProtocol(RunCommandProtocol):
+    """ Reports rsync's progress to C{onProgress} as it comes
+
+    Progress lines are left out of C{out}, they get rewritten with carriage
+    returns several times a second.
+    """
+    def __init__(self, onProgress=None, capture=None):
+        RunCommandProtocol.__init__(self, capture)
+        self.onProgress = onProgress
+        self._partial = ""
+
+    def dataReceived(self, bytes):
+        lines = re.split(r"(\r|\n)", self._partial + bytes)
+        self._partial = lines.pop()
+        for line, sep in zip(lines[::2], lines[1::2]):
+            progress = rsync_progress(line)
+            if progress is None:
+                self.out.write(line + sep)
+            elif self.onProgress is not None:
+                self.onProgress(progress)
+
+    def connectionLost(self, reason):
+        self.out.write(self._partial)
+        self._partial = ""
+        RunCommandProtocol.connectionLost(self, reason)
+
+    def commandExited(self, reason):
+        self.out.write(self._partial)
+        self._partial = ""
+        RunCommandProtocol.commandExited(self, reason)
 
 
 class UnknownServer(Exception):
     ''' Unknown server '''
 
+class ServerUnavailable(Exception):
+    ''' Server can't be reached, a new connection will be tried later '''
+
 class ServerManager(object):
-    def __init__(self, reactor, servers):
+    """ Keeps one connection to each server
+
+    A lost connection is dropped from the cache and reopened right away by
+    the next L{getServer}. Failed attempts are spaced by an exponential backoff,
+    starting at C{reconnect_delay} and up to C{reconnect_max_delay} seconds,
+    with some jitter so servers coming back don't get all their work at
+    once. Until then, L{getServer} fails with L{ServerUnavailable}.
+
+    Connections that ran no command for C{idle_timeout} seconds are closed,
+    along with their idle helper agent, the next L{getServer} reopens them. Servers L{hold}ed for a longer
+    operation are never closed meanwhile.
+    """
+    def __init__(self, reactor, servers,
+                 reconnect_delay=1, reconnect_max_delay=300, idle_timeout=0):
         self.reactor = reactor
         self.config = servers
         self.servers = {}
         self._deferreds = {}
+        self._syncLocks = {}
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        # Failed attempts in a row, and when to try again, by server name
+        self._failures = {}
+        self._retryAt = {}
+        self.idle_timeout = idle_timeout
+        self._lastUsed = {}
+        self._held = collections.defaultdict(int)
+        self._reaper = None
 
     def getServer(self, name):
         try:
@@ -52,6 +156,7 @@ class ServerManager(object):
             return defer.fail(UnknownServer(name))
 
         if name in self.servers:
+            self._lastUsed[name] = self.reactor.seconds()
             return defer.succeed(self.servers[name])
 
         d = defer.Deferred()
@@ -59,6 +164,12 @@ class ServerManager(object):
             self._deferreds[name].append(d)
             return d
 
+        retryAt = self._retryAt.get(name)
+        if retryAt is not None and self.reactor.seconds() < retryAt:
+            return defer.fail(ServerUnavailable(
+                "{0} is unavailable, retrying in {1:.1f}s".format(
+                    name, retryAt - self.reactor.seconds())))
+
         self._deferreds[name] = [d]
         self._openConnection(name, config).addCallbacks(
             self._openCb,
@@ -68,36 +179,165 @@ class ServerManager(object):
         )
         return d
 
+    def warmUp(self):
+        """ Connect to all servers at once
+
+        @return: a C{Deferred} firing with a C{dict} of the seconds each
+            server took to connect, or the C{Failure} if it couldn't
+        """
+        def _connected(result, name, started):
+            took = self.reactor.seconds() - started
+            if isinstance(result, Failure):
+                log.warning("Unable to connect to %s after %.2fs: %s",
+                            name, took, result.getErrorMessage())
+                return name, result
+            log.info("Connected to %s in %.2fs", name, took)
+            return name, took
+
+        started = self.reactor.seconds()
+        d = defer.gatherResults([
+            self.getServer(name).addBoth(_connected, name, started)
+            for name in sorted(self.config)
+        ])
+
+        @d.addCallback
+        def _done(results):
+            failed = [name for name, result in results
+                      if isinstance(result, Failure)]
+            log.info("Connected to %d of %d servers in %.2fs%s",
+                     len(results) - len(failed), len(results),
+                     self.reactor.seconds() - started,
+                     ", unreachable: " + ", ".join(failed) if failed else "")
+            return dict(results)
+        return d
+
+    def concurrencyLimit(self, key):
+        """ Get the concurrency limit for a server or a (source, dest) pair
+
+        @return: the limit, or C{None} when unlimited
+        """
+        if isinstance(key, tuple):
+            config = self.config.get(key[0])
+            return config.max_syncs if config else None
+
+        config = self.config.get(key)
+        return config.max_operations if config else None
+
+    def syncLock(self, source, dest):
+        """ Get the C{DeferredSemaphore} limiting transfers between servers
+
+        @return: the semaphore, or C{None} when unlimited
+        """
+        limit = self.concurrencyLimit((source, dest))
+        if not limit:
+            return None
+
+        key = (source, dest)
+        if key not in self._syncLocks:
+            self._syncLocks[key] = defer.DeferredSemaphore(limit)
+        return self._syncLocks[key]
+
+    def hold(self, *names):
+        """ Keep the connections to C{names} open until L{release}d """
+        for name in names:
+            self._held[name] += 1
+
+    def release(self, *names):
+        now = self.reactor.seconds()
+        for name in names:
+            self._held[name] -= 1
+            if not self._held[name]:
+                del self._held[name]
+            # Idle from now on
+            self._lastUsed[name] = now
+
     def _makeUpdater(self, server, config):
-        return ShareUpdater(server, config)
+        return ShareUpdater(server, config, self.reactor)
 
     def _openCb(self, server, name, config):
         su = self._makeUpdater(server, config)
 
         self.servers[name] = su
+        self._lastUsed[name] = self.reactor.seconds()
+        if self.idle_timeout and self._reaper is None:
+            self._reaper = task.LoopingCall(self._reapIdle)
+            self._reaper.clock = self.reactor
+            self._reaper.start(self.idle_timeout / 2.0, now=False)
+        self._failures.pop(name, None)
+        self._retryAt.pop(name, None)
+        server.notifyOnLost(lambda reason: self._lost(reason, name, su))
         for d in self._deferreds.pop(name, []):
             d.callback(su)
 
     def _openErr(self, reason, name):
-            for d in self._deferreds.pop(name, []):
-                d.errback(reason)
+        log.warning("Unable to connect to %s: %s",
+                    name, reason.getErrorMessage())
+        self._backoff(name)
+        for d in self._deferreds.pop(name, []):
+            d.errback(reason)
+
+    def _reapIdle(self):
+        now = self.reactor.seconds()
+        for name, su in self.servers.items():
+            idleSince = su.idleSince()
+            if idleSince is None or name in self._held:
+                continue
+            idle = now - max(idleSince, self._lastUsed.get(name, 0))
+            if idle >= self.idle_timeout:
+                log.info("Closing connection to %s, idle for %ds",
+                         name, idle)
+                del self.servers[name]
+                self._lastUsed.pop(name, None)
+                su.stopAgent()
+                su.server.loseConnection()
+
+        if not self.servers:
+            self._reaper.stop()
+            self._reaper = None
+
+    def _lost(self, reason, name, su):
+        if self.servers.get(name) is not su:
+            return
+        # Reconnected right away, only failed attempts are held back
+        del self.servers[name]
+
+    def _backoff(self, name):
+        failures = self._failures[name] = self._failures.get(name, 0) + 1
+        delay = min(self.reconnect_max_delay,
+                    self.reconnect_delay * 2 ** (failures - 1))
+        delay *= random.uniform(0.5, 1.0)
+        log.info("Next connection attempt to %s in %.1fs", name, delay)
+        self._retryAt[name] = self.reactor.seconds() + delay
 
     def _openConnection(self, name, config):
-        return SSHServer(self.reactor,
-                      hostname=config.hostname,
-                      port=config.port,
-                      user=config.user).connect()
+        return SSHServerPool(self.reactor,
+                             hostname=config.hostname,
+                             port=config.port,
+                             user=config.user,
+                             connections=config.connections,
+                             max_sessions=config.max_sessions,
+                             keepalive_interval=config.keepalive_interval,
+                             keepalive_count=config.keepalive_count).connect()
 
     def loseConnections(self):
+        if self._reaper is not None:
+            self._reaper.stop()
+            self._reaper = None
         while self.servers:
             key, su = self.servers.popitem()
             for d in self._deferreds.pop(key, []):
                 d.cancel()
-            su.server.connection.loseConnection()
+            su.server.loseConnection()
 
 
 class ShareUpdater(object):
-    def __init__(self, server, cfg):
+    # Paths checked at once, and how long to wait for more of them
+    stat_batch = 200
+    stat_delay = 0.1
+    # Output kept from each command, its start and end past that size
+    capture_size = 64 * 1024
+
+    def __init__(self, server, cfg, clock=None):
         self.server = server
         self.name = cfg.hostname
         self.root = cfg.root
@@ -105,6 +345,20 @@ class ShareUpdater(object):
 
         self.commands = ubuntu if cfg.commands is None else cfg.commands
 
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        if cfg.stat_batch is not None:
+            self.stat_batch = cfg.stat_batch
+        if cfg.stat_delay is not None:
+            self.stat_delay = cfg.stat_delay
+        if cfg.capture_size is not None:
+            self.capture_size = cfg.capture_size or None
+        self._stats = []
+        self._statCall = None
+        self.use_agent = bool(cfg.agent) and "agent" in self.commands
+        self._agent = None
+
         if self.archive_root is None:
             self.archive_root = os.path.join(self.root, ".tilde_archive")
         self.trash_root = cfg.trash_root
@@ -122,14 +376,95 @@ class ShareUpdater(object):
         realpath = os.path.join(base, shareabs)
         return realpath
 
+    def _run(self, name, protocol=RemoteCommandProtocol, **kw):
+        """ Run the C{name} command, formatted with C{kw}, with its timeout
+
+        @return: the C{protocol} instance
+        """
+        return self.server.runCommand(self.commands[name].format(**kw),
+                                      protocol=protocol,
+                                      timeout=self.commands.timeout(name))
+
+    def _capture(self):
+        """ Protocol factory keeping up to C{capture_size} of the output """
+        return lambda: RunCommandProtocol(self.capture_size)
+
+    def _getAgent(self):
+        """ The running helper agent, started if needed, or C{None} """
+        if not self.use_agent:
+            return None
+        if self._agent is None or self._agent.lost:
+            agent = self._agent = self.server.runCommand(
+                self.commands.agent,
+                protocol=lambda: AgentProtocol(clock=self.clock))
+            agent.finished.addBoth(self._agentStopped, agent)
+        return self._agent
+
+    def _agentStopped(self, result, agent):
+        if self._agent is agent:
+            self._agent = None
+        agent._lost()
+        if not agent.ready:
+            log.warning("Helper agent didn't start on %s, using commands",
+                        self.name)
+            self.use_agent = False
+        if isinstance(result, Failure):
+            log_err(result, log, "Helper agent failed on " + self.name)
+
+    def stopAgent(self):
+        """ Stop the helper agent, if it is running """
+        agent, self._agent = self._agent, None
+        if agent is not None and not agent.lost:
+            agent.stop()
+
+    def idleSince(self):
+        """ When the server last ran a command, or C{None} if it is busy
+
+        The helper agent kept running doesn't count, only its requests do.
+        """
+        agent = self._agent
+        if agent is None or agent.lost:
+            return self.server.idleSince()
+
+        idleSince = self.server.idleSince(sessions=1)
+        agentIdleSince = agent.idleSince()
+        if idleSince is None or agentIdleSince is None:
+            return None
+        return max(idleSince, agentIdleSince)
+
+    def _viaAgent(self, op, fallback, **args):
+        """ Run C{op} with the helper agent, or C{fallback} without it """
+        agent = self._getAgent()
+        if agent is None:
+            return fallback()
+
+        def _unavailable(reason):
+            reason.trap(AgentUnavailable)
+            log.debug("Agent can't %s on %s, using commands: %s",
+                      op, self.name, reason.getErrorMessage())
+            return fallback()
+
+        d = agent.request(op, timeout=self.commands.timeout(op), **args)
+        return d.addErrback(_unavailable)
+
     def exists(self, path):
+        def _failed(reason):
+            reason.trap(AgentError)
+            return False
+
+        # Path info from the agent, True or False from the command
+        d = self._viaAgent("stat", lambda: self._cmd_exists(path), path=path)
+        return d.addCallbacks(bool, _failed)
+
+    def _cmd_exists(self, path):
         d = defer.Deferred()
-        cmd = self.server.runCommand(self.commands.test.format(path=path))
+        cmd = self._run("test", path=path).finished
 
         def _exists(reason):
             return True
 
         def _doesnt(reason):
+            reason.trap(ProcessTerminated)
             return False
 
         cmd.addCallbacks(_exists, _doesnt)
@@ -137,20 +472,82 @@ class ShareUpdater(object):
 
         return d
 
+    def _parse_path_info(self, info):
+        res = dict(zip(("type", "user", "group", "mode"),
+                        info.split(":"),
+                       ))
+        res["mode"] = int(res["mode"], 8)
+        return res
+
     def get_path_info(self, path):
+        """ Get the type, owner, group and mode of C{path}
+
+        Paths are checked in batches of up to C{stat_batch} with the
+        C{stat_many} command, when there is one.
+
+        @return: a C{Deferred} firing with a C{dict}, or C{None} when the
+            path doesn't exist. It fails when the path can't be checked.
+        """
+        return self._viaAgent("stat", lambda: self._cmd_path_info(path),
+                              path=path)
+
+    def _cmd_path_info(self, path):
+        if (self.stat_batch <= 1 or
+                "stat_many" not in self.commands or
+                "\n" in path):
+            return self._get_path_info(path)
+
+        d = defer.Deferred()
+        self._stats.append((path, d))
+        if len(self._stats) >= self.stat_batch:
+            self._flushStats()
+        elif self._statCall is None:
+            self._statCall = self.clock.callLater(self.stat_delay,
+                                                  self._flushStats)
+        return d
+
+    def _flushStats(self):
+        if self._statCall is not None:
+            if self._statCall.active():
+                self._statCall.cancel()
+            self._statCall = None
+
+        batch, self._stats = self._stats, []
+        if not batch:
+            return
+
+        cmd = self._run(
+            "stat_many",
+            protocol=lambda: InputCommandProtocol(
+                "".join(path + "\n" for path, d in batch)))
+
+        def _parse_out(reason):
+            lines = cmd.out.getvalue().splitlines()
+            log.debug("Checked %d paths on %s", len(batch), self.name)
+            for i, (path, d) in enumerate(batch):
+                info = lines[i].strip() if i < len(lines) else "error"
+                if info == "missing":
+                    d.callback(None)
+                elif info.startswith("ok:"):
+                    d.callback(self._parse_path_info(info[3:]))
+                else:
+                    d.errback(Exception(
+                        "Unable to get path info for {0}".format(path)))
+
+        def _failed(reason):
+            for path, d in batch:
+                d.errback(reason)
+
+        cmd.finished.addCallbacks(_parse_out, _failed)
+
+    def _get_path_info(self, path):
         d = defer.Deferred()
-        cmd = self.server.runCommand(
-            self.commands.stat.format(path=path),
-            protocol=RunCommandProtocol)
+        cmd = self._run("stat", self._capture(), path=path)
 
         def _parse_out(reason):
             info = cmd.out.getvalue().splitlines()[0].strip()
             log.debug("Path info for %s %s: %s", self.name, path, info)
-            res = dict(zip(("type", "user", "group", "mode"),
-                            info.split(":"),
-                           ))
-            res["mode"] = int(res["mode"], 8)
-            return res
+            return self._parse_path_info(info)
 
         def _failed(reason):
             reason.trap(ProcessTerminated)
@@ -161,20 +558,32 @@ class ShareUpdater(object):
 
     def _make_parent(self, path):
         parent = os.path.split(os.path.normpath(path))[0]
-        return self.server.runCommand(self.commands.mkdir.format(path=parent)
-                                     ).finished
+        return self._viaAgent("mkdir", lambda: self._cmd_mkdir(parent),
+                              path=parent)
+
+    def _cmd_mkdir(self, path):
+        return self._run("mkdir", path=path).finished
 
 
     def create_home(self, home):
-        d = defer.Deferred()
         realpath = self.get_real_path(home.path)
-        cmd = self.commands.mkhome.format(
-            path=realpath,
-            owner=home.owner or '',
-            group=home.group or '',
-        )
+        owner, group = home.owner or '', home.group or ''
+
+        def _failed(reason):
+            reason.trap(AgentError)
+            log.warning("Unable to create %s on %s: %s",
+                        realpath, self.name, reason.getErrorMessage())
+            return False
 
-        cmd = self.server.runCommand(cmd)
+        d = self._viaAgent(
+            "mkhome",
+            lambda: self._cmd_create_home(realpath, owner, group),
+            path=realpath, owner=owner, group=group)
+        return d.addErrback(_failed)
+
+    def _cmd_create_home(self, realpath, owner, group):
+        d = defer.Deferred()
+        cmd = self._run("mkhome", path=realpath, owner=owner, group=group)
 
         def _success(reason):
             return True
@@ -187,7 +596,14 @@ class ShareUpdater(object):
         cmd.finished.chainDeferred(d)
         return d
 
-    def sync(self, fromState, to, home):
+    def sync(self, fromState, to, home, progress=None):
+        """ Copy C{fromState} to C{home}'s path on C{to}
+
+        @param progress: called with progress reported by the sync command,
+            see L{rsync_progress}
+        @return: a C{Deferred} firing with the number of bytes copied, when
+            the sync command reports them like rsync's C{--stats} does
+        """
         if fromState.status == models.HomeState.ACTIVE:
             src_base = self.root
         else:
@@ -196,16 +612,16 @@ class ShareUpdater(object):
         source_path = self.get_real_path(fromState.path, src_base)
         to_path = to.get_real_path(home.path)
 
-        cmd = self.commands.sync.format(
-            src_path=source_path,
-            dst=to.name,
-            dst_path=to_path,
-        )
-
         d = to._make_parent(to_path)
         @d.addBoth
         def _then(*r):
-            return self.server.runCommand(cmd).finished
+            cmd = self._run("sync",
+                            lambda: RsyncProtocol(progress, self.capture_size),
+                            src_path=source_path,
+                            dst=to.name,
+                            dst_path=to_path)
+            return cmd.finished.addCallback(
+                lambda r: rsync_transferred(cmd.out.getvalue()))
 
         return d
 
@@ -224,6 +640,17 @@ class ShareUpdater(object):
             src_dir = self.archive_root
         return self.get_path_info(self.get_real_path(homestate.path, src_dir))
 
+    def checkStatuses(self, homestates):
+        """ Same as L{checkStatus} for many C{homestates}
+
+        They are all checked right away, in as few commands as possible.
+
+        @return: a C{Deferred} firing with the results of a C{DeferredList}
+        """
+        checks = [self.checkStatus(s) for s in homestates]
+        self._flushStats()
+        return defer.DeferredList(checks, consumeErrors=True)
+
     def move(self, homestate, toPath):
         if homestate.status == models.HomeState.ACTIVE:
             src_dir = self.root
@@ -235,9 +662,12 @@ class ShareUpdater(object):
         return self._make_parent(dst).addCallback(lambda *r: self._move(src, dst))
 
     def _move(self, source, dest):
-        cmd = self.server.runCommand(
-            self.commands.move.format(src_path=source, dst_path=dest),
-            protocol=RunCommandProtocol)
+        return self._viaAgent("move", lambda: self._cmd_move(source, dest),
+                              src_path=source, dst_path=dest)
+
+    def _cmd_move(self, source, dest):
+        cmd = self._run("move", self._capture(),
+                        src_path=source, dst_path=dest)
 
         def _failed(reason):
             log_err(reason, log,
@@ -258,7 +688,4 @@ class ShareUpdater(object):
         return self._make_parent(dst).addCallback(lambda *r: self._move(src, dst))
 
     def namedCommand(self, name, **kw):
-        return self.server.runCommand(
-            self.commands[name].format(**kw),
-            protocol=RunCommandProtocol,
-        ).finished
+        return self._run(name, self._capture(), **kw).finished
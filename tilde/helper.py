@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+#
+# (C) Copyright Révolution Linux 2012
+#
+# Authors:
+# Vincent Vinet <vince.vinet@gmail.com>
+#
+# This file is part of tilde.
+#
+# tilde is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tilde is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tilde.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Helper agent run on file servers
+
+tilde sends this file over an SSH channel to a python interpreter on the
+file server, then sends it one JSON request per line on standard input.
+Each request gets a JSON response line on standard output, with the same
+id and either a result or an error.
+
+It only uses the standard library and runs on python 2.6 and later.
+"""
+
+import errno
+import grp
+import json
+import os
+import pwd
+import re
+import stat
+import sys
+
+
+TYPES = [
+    (stat.S_ISDIR, "directory"),
+    (stat.S_ISLNK, "symbolic link"),
+    (stat.S_ISFIFO, "fifo"),
+    (stat.S_ISSOCK, "socket"),
+    (stat.S_ISCHR, "character special file"),
+    (stat.S_ISBLK, "block special file"),
+]
+
+
+class Fallback(Exception):
+    """ The operation should be done with the usual command instead """
+
+
+def _user(uid):
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return "UNKNOWN"
+
+
+def _group(gid):
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return "UNKNOWN"
+
+
+def do_stat(path):
+    """ Same as stat -c%F:%U:%G:%a, or None when the path doesn't exist """
+    try:
+        st = os.lstat(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+    for test, name in TYPES:
+        if test(st.st_mode):
+            break
+    else:
+        name = "regular file" if st.st_size else "regular empty file"
+
+    return {
+        "type": name,
+        "user": _user(st.st_uid),
+        "group": _group(st.st_gid),
+        "mode": stat.S_IMODE(st.st_mode),
+    }
+
+
+def do_mkdir(path, mode=None):
+    """ Same as mkdir -p """
+    if not os.path.isdir(path):
+        if mode is None:
+            os.makedirs(path)
+        else:
+            os.makedirs(path, mode)
+    return True
+
+
+def _backup_name(path):
+    """ Next numbered backup name, as mv --backup=t would use """
+    parent, base = os.path.split(path)
+    pattern = re.compile(re.escape(base) + r"\.~(\d+)~$")
+    numbers = [int(m.group(1))
+               for m in (pattern.match(name)
+                         for name in os.listdir(parent or "."))
+               if m]
+    return "{0}.~{1}~".format(path, max(numbers or [0]) + 1)
+
+
+def do_move(src_path, dst_path):
+    """ Same as mv -T --backup=t """
+    if os.path.lexists(dst_path):
+        os.rename(dst_path, _backup_name(dst_path))
+    try:
+        os.rename(src_path, dst_path)
+    except OSError:
+        if os.path.lexists(src_path) and not os.path.lexists(dst_path):
+            # Most likely across devices, leave that to mv
+            raise Fallback("Unable to rename {0}".format(src_path))
+        raise
+    return True
+
+
+def _uid(owner):
+    if not owner:
+        return -1
+    if owner.isdigit():
+        return int(owner)
+    return pwd.getpwnam(owner).pw_uid
+
+
+def _gid(group):
+    if not group:
+        return -1
+    if group.isdigit():
+        return int(group)
+    return grp.getgrnam(group).gr_gid
+
+
+def do_mkhome(path, owner, group):
+    """ Same as mkdir -p -m750, chown owner:group and chmod 750 """
+    do_mkdir(path, 0o750)
+    os.chown(path, _uid(owner), _gid(group))
+    os.chmod(path, 0o750)
+    return True
+
+
+OPERATIONS = {
+    "stat": do_stat,
+    "mkdir": do_mkdir,
+    "move": do_move,
+    "mkhome": do_mkhome,
+}
+
+
+def handle(line):
+    """ Answer a request line with a response line """
+    response = {}
+    try:
+        request = json.loads(line)
+        response["id"] = request.get("id")
+        operation = OPERATIONS[request["op"]]
+        response["result"] = operation(**request.get("args", {}))
+    except Fallback as e:
+        response["error"] = str(e)
+        response["fallback"] = True
+    except Exception as e:
+        response["error"] = "{0}: {1}".format(type(e).__name__, e)
+    return json.dumps(response)
+
+
+def main(stdin=sys.stdin, stdout=sys.stdout):
+    stdout.write("ready\n")
+    stdout.flush()
+    for line in iter(stdin.readline, ""):
+        if line.strip():
+            stdout.write(handle(line) + "\n")
+            stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+#
+# (C) Copyright Révolution Linux 2012
+#
+# Authors:
+# Vincent Vinet <vince.vinet@gmail.com>
+#
+# This file is part of tilde.
+#
+# tilde is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tilde is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tilde.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import itertools
+import logging
+log = logging.getLogger(__name__)
+
+from twisted.internet import defer
+
+from tilde.util import log_err
+
+
+class Job(object):
+    """ Work running in the background, see L{JobManager.submit} """
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, id, keys, started, progress=None):
+        self.id = id
+        self.keys = keys
+        self.state = self.RUNNING
+        self.started = started
+        self.finished = None
+        self.result = None
+        self.error = None
+        self._progress = progress
+
+    def to_json(self):
+        return dict(
+            id=self.id,
+            state=self.state,
+            started=self.started,
+            finished=self.finished,
+            progress=self._progress() if self._progress else None,
+            result=self.result,
+            error=self.error,
+        )
+
+
+class JobConflict(Exception):
+    """ Another running job holds some of the keys """
+    def __init__(self, job):
+        Exception.__init__(self, "Conflicts with job {0}".format(job.id))
+        self.job = job
+
+
+class JobManager(object):
+    """ Runs jobs in the background, a single one at a time for each key
+
+    Finished jobs can still be looked up for C{keep} seconds.
+    """
+
+    def __init__(self, keep=3600, clock=None):
+        self.keep = keep
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.jobs = {}
+        self._running = {}
+        self._ids = itertools.count(1)
+
+    def get(self, id):
+        return self.jobs.get(id)
+
+    def submit(self, keys, func, *args, **kw):
+        """ Run C{func} unless a job holding any of C{keys} is running
+
+        @param progress: optional callable reporting the job's progress
+        @return: the new job, or the one already running for C{keys}
+        @raise JobConflict: when a job for other keys holds some of C{keys}
+        """
+        keys = tuple(keys)
+        for key in keys:
+            running = self._running.get(key)
+            if running is None:
+                continue
+            if running.keys == keys:
+                return running
+            raise JobConflict(running)
+
+        job = Job(next(self._ids), keys, self.clock.seconds(),
+                  kw.pop("progress", None))
+        self.jobs[job.id] = job
+        for key in keys:
+            self._running[key] = job
+        log.info("Started job %d for %r", job.id, keys)
+
+        d = defer.maybeDeferred(func, *args, **kw)
+        d.addCallbacks(self._done, self._failed,
+                       callbackArgs=(job,), errbackArgs=(job,))
+        return job
+
+    def _done(self, result, job):
+        job.state = Job.DONE
+        job.result = result
+        self._finish(job)
+
+    def _failed(self, reason, job):
+        log_err(reason, log, "Job {0} failed".format(job.id))
+        job.state = Job.FAILED
+        job.error = reason.getErrorMessage()
+        self._finish(job)
+
+    def _finish(self, job):
+        job.finished = self.clock.seconds()
+        for key in job.keys:
+            self._running.pop(key, None)
+        self.clock.callLater(self.keep, self.jobs.pop, job.id, None)
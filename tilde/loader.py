@@ -36,7 +36,17 @@ class Server(object):
                  port=22,
                  archive_root=None,
                  trash_root=None,
-                 commands=None):
+                 commands=None,
+                 max_operations=None,
+                 max_syncs=None,
+                 stat_batch=None,
+                 stat_delay=None,
+                 agent=None,
+                 keepalive_interval=None,
+                 keepalive_count=None,
+                 connections=None,
+                 max_sessions=None,
+                 capture_size=None):
         self.hostname = hostname
         self.root = root
         self.user = user
@@ -44,6 +54,31 @@ class Server(object):
         self.archive_root = archive_root
         self.trash_root = trash_root
         self.commands = commands
+        # Concurrent operations on this server, and concurrent transfers
+        # from this server to each other one. None is unlimited
+        self.max_operations = int(max_operations) if max_operations else None
+        self.max_syncs = int(max_syncs) if max_syncs else None
+        # Paths checked with a single command, 0 checks them one by one
+        self.stat_batch = int(stat_batch) if stat_batch is not None else None
+        # Seconds to wait for more paths before checking them
+        self.stat_delay = (float(stat_delay)
+                           if stat_delay is not None else None)
+        # Run simple operations through a helper agent kept running
+        self.agent = str(agent).lower() in ("1", "yes", "true", "on")
+        # Seconds between SSH keepalives, 0 disables them, and how many may
+        # go unanswered before reconnecting
+        self.keepalive_interval = (int(keepalive_interval)
+                                   if keepalive_interval is not None else 30)
+        self.keepalive_count = (int(keepalive_count)
+                                if keepalive_count is not None else 3)
+        # Connections opened to this server, and channels open at once on
+        # each of them, 0 is unlimited
+        self.connections = int(connections) if connections else 1
+        self.max_sessions = (int(max_sessions)
+                             if max_sessions is not None else 10)
+        # Output kept from each command, 0 keeps all of it
+        self.capture_size = (int(capture_size)
+                             if capture_size is not None else None)
 
     def __repr__(self):
         return repr(self.__dict__)
@@ -89,6 +89,13 @@ class Home(Storm):
         else:
             return "active" != status.status
 
+    @classmethod
+    def fromRow(cls, row):
+        """ Build a home from a row of L{HOME_COLUMNS} values """
+        h = cls()
+        h.id, h.server_name, h.path, h.owner, h.group, h.uuid, h.ts = row
+        return h
+
     def copy(self):
         h = Home()
         h.id = self.id
@@ -154,6 +161,13 @@ class HomeState(Storm):
             setattr(new, k, v)
         return new
 
+    @classmethod
+    def fromRow(cls, row):
+        """ Build a state from a row of L{STATE_COLUMNS} values """
+        new = cls()
+        new.id, new.server_name, new.path, new.status, new.ts = row
+        return new
+
     @classmethod
     def fromHome(cls, home, status=ACTIVE, ts=None):
         new = cls()
@@ -165,3 +179,22 @@ class HomeState(Storm):
             ts = datetime.now().replace(tzinfo=tz.tzlocal())
         new.ts = ts
         return new
+
+
+HOME_COLUMNS = (
+    Home.id,
+    Home.server_name,
+    Home.path,
+    Home.owner,
+    Home.group,
+    Home.uuid,
+    Home.ts,
+)
+
+STATE_COLUMNS = (
+    HomeState.id,
+    HomeState.server_name,
+    HomeState.path,
+    HomeState.status,
+    HomeState.ts,
+)
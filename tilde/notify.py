@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+#
+# (C) Copyright Révolution Linux 2012
+#
+# Authors:
+# Vincent Vinet <vince.vinet@gmail.com>
+#
+# This file is part of tilde.
+#
+# tilde is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tilde is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tilde.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+log = logging.getLogger(__name__)
+
+from zope.interface import implements
+
+from twisted.internet import threads
+from twisted.internet.interfaces import IReadDescriptor
+from twisted.python.failure import Failure
+
+from storm.uri import URI
+from storm.databases.postgres import make_dsn
+
+from tilde.util import log_err
+
+
+class NotifyListener(object):
+    """ Listens to PostgreSQL notifications on a dedicated connection
+
+    The connection is opened in a thread, then its socket is watched by the
+    reactor and notifications are handed to C{callback} as they arrive,
+    with their payload.
+
+    Notifications sent while not listening are lost, C{connected} is called
+    each time listening starts, after the first connection or a new one.
+    """
+    implements(IReadDescriptor)
+
+    def __init__(self, reactor, dburl, channel, retry_delay=10):
+        self.reactor = reactor
+        self.dsn = make_dsn(URI(dburl))
+        self.channel = channel
+        self.retry_delay = retry_delay
+        self.callback = None
+        self.connected = None
+        self.conn = None
+        self._retry = None
+        self._stopped = True
+
+    def logPrefix(self):
+        return "NotifyListener"
+
+    def start(self, callback, connected=None):
+        self.callback = callback
+        self.connected = connected
+        self._stopped = False
+        return self._connect()
+
+    def stop(self):
+        self._stopped = True
+        if self._retry is not None and self._retry.active():
+            self._retry.cancel()
+        self._retry = None
+        self._disconnect()
+
+    def _connect(self):
+        self._retry = None
+        d = threads.deferToThread(self._blockingConnect)
+        d.addCallbacks(self._connected, self._connectionFailed)
+        return d
+
+    def _blockingConnect(self):
+        import psycopg2
+        import psycopg2.extensions
+
+        conn = psycopg2.connect(self.dsn)
+        conn.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = conn.cursor()
+        cursor.execute('LISTEN "{0}"'.format(self.channel.replace('"', '""')))
+        cursor.close()
+        return conn
+
+    def _connected(self, conn):
+        if self._stopped:
+            conn.close()
+            return
+
+        log.info("Listening to notifications on %s", self.channel)
+        self.conn = conn
+        self.reactor.addReader(self)
+        if self.connected is not None:
+            try:
+                self.connected()
+            except Exception:
+                log.exception("Failed to handle the connection")
+
+    def _connectionFailed(self, reason):
+        log_err(reason, log, "Unable to listen to {0}".format(self.channel))
+        self._scheduleRetry()
+
+    def _scheduleRetry(self):
+        if not self._stopped and self._retry is None:
+            self._retry = self.reactor.callLater(self.retry_delay,
+                                                 self._connect)
+
+    def _disconnect(self):
+        if self.conn is not None:
+            self.reactor.removeReader(self)
+            try:
+                self.conn.close()
+            except Exception:
+                log.exception("Failed to close the notification connection")
+            self.conn = None
+
+    def fileno(self):
+        if self.conn is None:
+            return -1
+        return self.conn.fileno()
+
+    def doRead(self):
+        try:
+            self.conn.poll()
+        except Exception:
+            self.connectionLost(Failure())
+            return
+
+        while self.conn.notifies:
+            notify = self.conn.notifies.pop(0)
+            try:
+                self.callback(notify.payload)
+            except Exception:
+                log.exception("Failed to handle notification %r",
+                              notify.payload)
+
+    def connectionLost(self, reason):
+        log_err(reason, log, "Lost notification connection")
+        self._disconnect()
+        self._scheduleRetry()
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import logging
 mlog = logging.getLogger(__name__)
@@ -8,13 +9,16 @@ from zope.interface import implements
 from twisted.cred.portal import IRealm, Portal
 from twisted.cred.checkers import InMemoryUsernamePasswordDatabaseDontUse
 from twisted.internet import defer
+from twisted.internet.interfaces import IPushProducer
 from twisted.python import failure
-from twisted.web.resource import IResource, Resource
-from twisted.web import server
+from twisted.python.urlpath import URLPath
+from twisted.web.resource import IResource, NoResource, Resource
+from twisted.web import http, server
 from twisted.web.guard import HTTPAuthSessionWrapper, DigestCredentialFactory
 
 from tilde.models import Home, HomeState
 from tilde.commands import Commands
+from tilde.jobs import JobConflict, JobManager
 
 
 def use_to_json(obj):
@@ -57,13 +61,193 @@ class TildeRESTRealm(object):
 class HomeResource(Resource):
     isLeaf = 1
 
-    def __init__(self, service, q):
+    def __init__(self, service, q, find=None):
         Resource.__init__(self)
         self.service = service
         self.q = q
+        # Cache aware lookup, used instead of searching for q
+        self.find = find
 
     def render_GET(self, request):
-        d = self.service.findHome(*self.q)
+        if self.find is not None:
+            d = self.find()
+        else:
+            d = self.service.findHome(*self.q)
+        d.addCallback(self._gotHomes, request)
+        d.addErrback(to_json, request)
+        return server.NOT_DONE_YET
+
+    def _gotHomes(self, homes, request):
+        body = json.dumps({"homes":homes}, default=use_to_json)
+        if homes:
+            # The tag is that of the body, setETag answers 304 when the
+            # client has it already
+            etag = '"{0}"'.format(hashlib.sha1(body).hexdigest())
+            if request.setETag(etag) == http.CACHED:
+                request.finish()
+                return
+
+        request.setHeader("Content-Type", "application/json")
+        request.write(body)
+        request.finish()
+
+
+class Pacer(object):
+    """ Push producer telling when the client is ready for more """
+    implements(IPushProducer)
+
+    def __init__(self):
+        self.stopped = False
+        self._paused = None
+
+    def wait(self):
+        """ @return: a C{Deferred} firing once the client takes more """
+        if self._paused is None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._paused.addCallback(lambda r: d.callback(None))
+        return d
+
+    def pauseProducing(self):
+        if self._paused is None:
+            self._paused = defer.Deferred()
+
+    def resumeProducing(self):
+        paused, self._paused = self._paused, None
+        if paused is not None:
+            paused.callback(None)
+
+    def stopProducing(self):
+        self.stopped = True
+        self.resumeProducing()
+
+
+class HomeList(Resource):
+    """ Lists homes by id, written out as they are read
+
+    Takes C{after}, the last id already seen, C{limit}, the most homes to
+    return with 0 for all of them, and C{server_name} and C{status} filters.
+    The response has the homes and C{next}, the C{after} value to get the
+    following ones, or C{null} once they have all been listed.
+    """
+    isLeaf = 1
+    page_size = 500
+
+    def __init__(self, service):
+        Resource.__init__(self)
+        self.service = service
+
+    def render_GET(self, request):
+        try:
+            after = request.args.get('after', [None])[0]
+            after = int(after) if after else None
+            limit = int(request.args.get('limit', [0])[0])
+            if limit < 0:
+                raise ValueError("limit can't be negative")
+        except ValueError, e:
+            request.setResponseCode(400)
+            request.setHeader("Content-Type", "application/json")
+            return json.dumps({"error":str(e)})
+
+        server_name = request.args.get('server_name', [None])[0]
+        status = request.args.get('status', [None])[0]
+        self.stream(request, after, limit,
+                    server_name and server_name.decode("utf-8"),
+                    status and status.decode("utf-8"))
+        return server.NOT_DONE_YET
+
+    @defer.inlineCallbacks
+    def stream(self, request, after, limit, server_name, status):
+        # The next page is only read once the client took the last one
+        pacer = Pacer()
+        request.registerProducer(pacer, True)
+        request.notifyFinish().addErrback(lambda r: pacer.stopProducing())
+
+        count = 0
+        more = True
+        while more:
+            yield pacer.wait()
+            if pacer.stopped:
+                break
+
+            size = max(self.page_size, 1)
+            if limit:
+                size = min(size, limit - count)
+            try:
+                # One more tells whether there are homes after this page
+                homes = yield self.service.listHomes(after, size + 1,
+                                                     server_name, status)
+            except Exception:
+                request.unregisterProducer()
+                if count:
+                    # Too late for an error response, cut it short
+                    mlog.exception("Failed listing homes after %s", after)
+                    request.finish()
+                else:
+                    to_json(failure.Failure(), request)
+                return
+
+            following = len(homes) > size
+            homes = homes[:size]
+            if not count:
+                request.setHeader("Content-Type", "application/json")
+                request.write('{"homes": [')
+            elif homes:
+                request.write(",")
+            request.write(",".join(json.dumps(home, default=use_to_json)
+                                   for home in homes))
+            count += len(homes)
+            if homes:
+                after = homes[-1].id
+            more = following and (not limit or count < limit)
+
+        if not pacer.stopped:
+            request.unregisterProducer()
+            request.write('], "next": {0}}}'.format(json.dumps(
+                after if following and limit and count >= limit else None)))
+            request.finish()
+
+
+class Lookup(Resource):
+    """ Finds many homes at once
+
+    Takes a JSON object with C{ids} and/or C{uuids} lists, and C{states}
+    set to true to get the states of each home along with it.
+    """
+    isLeaf = 1
+    max_keys = 1000
+
+    def __init__(self, service):
+        Resource.__init__(self)
+        self.service = service
+
+    def _error(self, request, message):
+        request.setResponseCode(400)
+        request.setHeader("Content-Type", "application/json")
+        return json.dumps({"error":message})
+
+    def render_POST(self, request):
+        try:
+            query = json.loads(request.content.read())
+            ids = query.get("ids", [])
+            uuids = query.get("uuids", [])
+            if not isinstance(ids, list) or not isinstance(uuids, list):
+                raise TypeError("ids and uuids must be lists")
+            ids = [int(i) for i in ids]
+            uuids = [unicode(u) for u in uuids]
+            states = bool(query.get("states", False))
+        except (ValueError, TypeError, AttributeError), e:
+            return self._error(request, "Invalid query: {0}".format(e))
+
+        if len(ids) + len(uuids) > self.max_keys:
+            return self._error(request, "At most {0} ids and uuids".format(
+                self.max_keys))
+
+        d = self.service.lookupHomes(ids, uuids, states)
+        if states:
+            d.addCallback(lambda found: [
+                dict(home.to_json(), states=homestates)
+                for home, homestates in found])
         d.addCallback(lambda homes: {"homes":homes})
         d.addBoth(to_json, request)
         return server.NOT_DONE_YET
@@ -75,7 +259,9 @@ class ByUUID(Resource):
         self.service = service
 
     def getChild(self, name, request):
-        return HomeResource(self.service, (Home.uuid == name.decode("utf-8"),))
+        uuid = name.decode("utf-8")
+        return HomeResource(self.service, (Home.uuid == uuid,),
+                            lambda: self.service.findHomeByUUID(uuid))
 
 class ByID(Resource):
     def __init__(self, service):
@@ -83,16 +269,37 @@ class ByID(Resource):
         self.service = service
 
     def getChild(self, name, request):
-        return HomeResource(self.service, (Home.id == int(name),))
+        id = int(name)
+        return HomeResource(self.service, (Home.id == id,),
+                            lambda: self.service.findHomeById(id))
 
 
-class Merge(Resource):
+class Progress(Resource):
     isLeaf = 1
 
     def __init__(self, service):
         Resource.__init__(self)
         self.service = service
 
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "application/json")
+        return json.dumps({"transfers": self.service.getTransfers()})
+
+
+class Merge(Resource):
+    """ Merges a home into another
+
+    POST starts the merge as a job and answers with its id right away, see
+    L{Jobs}. Merging the same homes again while it runs gives the same job,
+    and merging either of them with another home is refused.
+    """
+    isLeaf = 1
+
+    def __init__(self, service, jobs):
+        Resource.__init__(self)
+        self.service = service
+        self.jobs = jobs
+
 
     def gotHomes(self, results):
         source, sstate, dest, dstate = results
@@ -208,12 +415,53 @@ class Merge(Resource):
             request.setHeader("Content-Type", "application/json")
             return json.dumps({"error":str(e)})
 
-        self.getHomes(source, dest).addCallback(
-            self.merge,
-            request.args.get('path', [""])[0].decode("utf-8"),
-        ).addBoth(to_json, request)
+        path = request.args.get('path', [""])[0].decode("utf-8")
+        try:
+            job = self.jobs.submit(
+                (source, dest),
+                lambda: self.getHomes(source, dest).addCallback(
+                    self.merge, path),
+                progress=lambda: self.service.transfers.get(source),
+            )
+        except JobConflict, e:
+            # Either home is already being merged with another one
+            request.setResponseCode(409)
+            request.setHeader("Content-Type", "application/json")
+            return json.dumps({"error":str(e), "job":e.job.id})
 
-        return server.NOT_DONE_YET
+        request.setResponseCode(202)
+        request.setHeader("Content-Type", "application/json")
+        location = URLPath.fromString(request.prePathURL()).sibling("jobs")
+        request.setHeader("Location", str(location.child(str(job.id))))
+        return json.dumps({"job":job.id}, default=use_to_json)
+
+
+class JobResource(Resource):
+    isLeaf = 1
+
+    def __init__(self, job):
+        Resource.__init__(self)
+        self.job = job
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "application/json")
+        return json.dumps(self.job, default=use_to_json)
+
+
+class Jobs(Resource):
+    """ State, progress and result of background jobs, by id """
+    def __init__(self, jobs):
+        Resource.__init__(self)
+        self.jobs = jobs
+
+    def getChild(self, name, request):
+        try:
+            job = self.jobs.get(int(name))
+        except ValueError:
+            job = None
+        if job is None:
+            return NoResource("No such job")
+        return JobResource(job)
 
 def getResource(rest_cfg, service):
     checkers = []
@@ -225,7 +473,12 @@ def getResource(rest_cfg, service):
     res = Resource()
     res.putChild("uuid", ByUUID(service))
     res.putChild("id", ByID(service))
-    res.putChild("merge", Merge(service))
+    jobs = JobManager()
+    res.putChild("merge", Merge(service, jobs))
+    res.putChild("jobs", Jobs(jobs))
+    res.putChild("progress", Progress(service))
+    res.putChild("homes", HomeList(service))
+    res.putChild("lookup", Lookup(service))
 
 
     #realm = TildeRESTRealm()
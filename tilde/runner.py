@@ -29,61 +29,200 @@ from tilde.util import log_err
 
 import itertools
 import operator
+import time
 
 from zope.component import getUtility
 
 from storm.zope.zstorm import IZStorm
 from storm.twisted.transact import Transactor, transact
-from storm.expr import LeftJoin, Desc
+from storm.expr import (
+    And,
+    Desc,
+    LeftJoin,
+    Or,
+    Select,
+    SQL,
+    Undef,
+)
 
 from twisted.application import service
 from twisted.internet import defer
 from twisted.internet import task
 from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 from twisted.web.server import Site
 
-from tilde.models import Home, HomeState
+from tilde.cache import HomeCache
+from tilde.models import Home, HomeState, HOME_COLUMNS, STATE_COLUMNS
 from tilde.core import ServerManager
+from tilde.notify import NotifyListener
 from tilde.rest import getResource
-
+from tilde.scheduler import Scheduler
+from tilde.writer import StateWriter
+
+
+# Same as Home.match, for homes grouped with their states: several states,
+# an active home without any state, or a single state that doesn't match.
+ACTIVE_HOME = "(tilde_home.path <> '' AND tilde_home.server_name IS NOT NULL)"
+DIRTY_HOMES = """
+count(tilde_home_state.id) > 1
+OR (count(tilde_home_state.id) = 0 AND {active})
+OR (count(tilde_home_state.id) = 1 AND NOT bool_and(COALESCE(
+    tilde_home_state.server_name IS NOT DISTINCT FROM tilde_home.server_name
+    AND CASE WHEN {active}
+        THEN tilde_home_state.path IS NOT DISTINCT FROM tilde_home.path
+             AND tilde_home_state.status IS NOT DISTINCT FROM 'active'
+        ELSE tilde_home_state.status IS DISTINCT FROM 'active'
+        END,
+    FALSE)))
+""".format(active=ACTIVE_HOME)
 
 
 class Updater(object):
-    def __init__(self, transactor, serverManager):
+    def __init__(self, transactor, serverManager, writer=None,
+                 converge_passes=1, converge_bytes=0, converge_seconds=0,
+                 cache=None):
         self.transactor = transactor
         self.serverManager = serverManager
+        # Optional StateWriter batching state changes
+        self.writer = writer
+        # Optional HomeCache answering lookups by id and uuid, once changes
+        # are listened to, see listening
+        self.cache = cache
+        self._listening = False
+        # Active homes get up to converge_passes syncs before being archived
+        # for the final one, stopping early once a pass copies less than
+        # converge_bytes or takes less than converge_seconds
+        self.converge_passes = max(converge_passes, 1)
+        self.converge_bytes = converge_bytes
+        self.converge_seconds = converge_seconds
+        # Progress of running syncs by home id, see _sync
+        self.transfers = {}
+
+    def _changedCondition(self, since, ids):
+        """ Condition matching homes touched at or after C{since}
+
+        Homes listed in C{ids} always match. When C{since} is C{None} only
+        those homes match, or every home if C{ids} is C{None} too.
+        """
+        if since is None and ids is None:
+            return Undef
+
+        conds = []
+        if since is not None:
+            conds.extend([
+                Home.ts >= since,
+                Home.id.is_in(Select(HomeState.id, HomeState.ts >= since)),
+            ])
+        if ids:
+            conds.append(Home.id.is_in(ids))
+        return Or(*conds)
 
     @transact
-    def listSharesToUpdate(self, since=None):
+    def getWatermark(self):
+        """ Get the most recent C{ts} found in either table """
         zs = getUtility(IZStorm).get("tilde")
-        zs.rollback()
-        for home, status in itertools.groupby(
-                zs.using(
-                        Home,
-                        LeftJoin(
-                            HomeState,
-                            Home.id == HomeState.id,
-                        ))
-                    .find((Home, HomeState))
-                    .order_by(Home.id, Desc(HomeState.ts)),
-                operator.itemgetter(0)):
-
-            status = [s.copy() for h,s in status if s is not None]
-            if ((len(status) > 1) or
-                (home.active and not status) or
-                (status and not home.match(status[0]))):
-                yield home.copy(), status
+        stamps = [
+            zs.find(Home).max(Home.ts),
+            zs.find(HomeState).max(HomeState.ts),
+        ]
+        stamps = [ts for ts in stamps if ts is not None]
+        return max(stamps) if stamps else None
+
+    def _dirtyHomes(self, since, ids, after=None, limit=None):
+        """ Select the ids of the homes that need to be updated
+
+        With C{limit}, only the first that many homes with an id above
+        C{after} are selected.
+        """
+        where = self._changedCondition(since, ids)
+        if after is not None:
+            where = Home.id > after if where is Undef else And(
+                where, Home.id > after)
+        return Select(
+            Home.id,
+            where=where,
+            tables=[Home, LeftJoin(HomeState, Home.id == HomeState.id)],
+            group_by=(Home.id, Home.server_name, Home.path),
+            having=SQL(DIRTY_HOMES),
+            order_by=Home.id if limit is not None else Undef,
+            limit=limit if limit is not None else Undef,
+        )
+
+    def _groupRows(self, rows):
+        """ Build homes and their states from joined rows, grouped by id """
+        size = len(HOME_COLUMNS)
+        for key, group in itertools.groupby(rows, operator.itemgetter(0)):
+            group = list(group)
+            status = [HomeState.fromRow(row[size:])
+                      for row in group
+                      if row[size] is not None]
+            yield Home.fromRow(group[0][:size]), status
 
     @transact
+    def listSharesToUpdate(self, since=None, ids=None, after=None,
+                           limit=None):
+        """ List the homes that need to be updated along with their states
+
+        The selection is done by the database, only plain values for dirty
+        homes are fetched, newest states first. With C{limit}, only the first
+        that many dirty homes with an id above C{after} are listed.
+        """
+        zs = getUtility(IZStorm).get("tilde")
+        zs.rollback()
+        rows = zs.using(
+                    Home,
+                    LeftJoin(
+                        HomeState,
+                        Home.id == HomeState.id,
+                    )
+                ).find(HOME_COLUMNS + STATE_COLUMNS,
+                       Home.id.is_in(
+                           self._dirtyHomes(since, ids, after, limit))
+                ).order_by(Home.id, Desc(HomeState.ts))
+        return list(self._groupRows(rows))
+
+    @defer.inlineCallbacks
+    def streamSharesToUpdate(self, consumer, since=None, ids=None,
+                             batch_size=1000):
+        """ Feed the homes that need to be updated to C{consumer} in batches
+
+        Homes are listed by id, C{batch_size} at a time, each batch in its
+        own transaction. C{consumer} is called with each list of
+        C{(home, states)}, and may return a C{Deferred} to hold back the next
+        batch until it is ready for more.
+        """
+        after = None
+        while True:
+            batch = yield self.listSharesToUpdate(since, ids, after,
+                                                  batch_size)
+            if batch:
+                yield consumer(batch)
+            if len(batch) < batch_size:
+                break
+            after = batch[-1][0].id
+
     def deleteState(self, homestate):
+        if self.writer is not None:
+            return self.writer.deleteState(homestate)
+        return self._deleteState(homestate)
+
+    @transact
+    def _deleteState(self, homestate):
         zs = getUtility(IZStorm).get("tilde")
         # Get a local copy for thread safety reasons
         hs = zs.get(HomeState, (homestate.id, homestate.server_name))
         zs.remove(hs)
 
+    def deleteHome(self, home):
+        if self.writer is not None:
+            d = self.writer.deleteHome(home)
+        else:
+            d = self._deleteHome(home)
+        return self._invalidating(d, home.id)
 
     @transact
-    def deleteHome(self, home):
+    def _deleteHome(self, home):
         zs = getUtility(IZStorm).get("tilde")
         # Get a local copy for thread safety reasons
         home = zs.get(Home, home.id)
@@ -92,9 +231,74 @@ class Updater(object):
                 zs.remove(hs)
             zs.remove(home)
 
+    def updateState(self, homestate):
+        if self.writer is not None:
+            d = self.writer.updateState(homestate)
+        else:
+            d = self._updateState(homestate)
+        return self._invalidating(d, homestate.id)
+
+    def _invalidating(self, d, id):
+        """ Drop home C{id} from the cache once C{d} has committed """
+        if self.cache is None:
+            return d
+
+        def _invalidate(result):
+            self.cache.invalidate(id)
+            return result
+        return d.addBoth(_invalidate)
+
+    def homeChanged(self, id):
+        """ Home C{id} was changed by someone else """
+        if self.cache is not None:
+            # It may be a new home, or have a new uuid
+            self.cache.invalidate(id, uuids=True)
+
+    def listening(self):
+        """ Changes made by others are listened to, from now on
+
+        Those made before were missed, the cache starts over.
+        """
+        if self.cache is not None:
+            self.cache.clear()
+        self._listening = True
+
+    def findHomeById(self, id):
+        """ Same as C{findHome(Home.id == id)}, from the cache if possible """
+        def _cached():
+            home = self.cache.get(id)
+            return None if home is None else [home]
+
+        def _store(homes, token):
+            for home in homes:
+                self.cache.put(home, token)
+        return self._cachedHomes(_cached, _store, Home.id == id)
+
+    def findHomeByUUID(self, uuid):
+        return self._cachedHomes(
+            lambda: self.cache.getByUUID(uuid),
+            lambda homes, token: self.cache.putUUID(uuid, homes, token),
+            Home.uuid == uuid)
+
+    def _cachedHomes(self, cached, store, condition):
+        if self.cache is None or not self._listening:
+            return self.findHome(condition)
+
+        homes = cached()
+        if homes is not None:
+            return defer.succeed(homes)
+
+        token = self.cache.token()
+        d = self.findHome(condition)
+
+        @d.addCallback
+        def _found(homes):
+            store(homes, token)
+            return homes
+        return d
 
     @transact
-    def updateState(self, homestate):
+    def _updateState(self, homestate):
         zs = getUtility(IZStorm).get("tilde")
         # Get a local copy for thread safety reasons
         hs = zs.get(HomeState, (homestate.id, homestate.server_name))
@@ -121,6 +325,52 @@ class Updater(object):
         res = zs.find(Home, *condition)
         return [s.copy() for s in res]
 
+    @transact
+    def lookupHomes(self, ids=(), uuids=(), states=False):
+        """ Get the homes with any of C{ids} or C{uuids}
+
+        @param states: also get the states of the homes found
+        @return: a list of homes, or of (home, [states]) with C{states}
+        """
+        zs = getUtility(IZStorm).get("tilde")
+        conds = []
+        if ids:
+            conds.append(Home.id.is_in(ids))
+        if uuids:
+            conds.append(Home.uuid.is_in(uuids))
+        if not conds:
+            return []
+
+        homes = [h.copy() for h in zs.find(Home, Or(*conds))]
+        if not states:
+            return homes
+
+        byId = dict((h.id, []) for h in homes)
+        if byId:
+            for s in zs.find(HomeState, HomeState.id.is_in(byId.keys())):
+                byId[s.id].append(s.copy())
+        return [(h, byId[h.id]) for h in homes]
+
+    @transact
+    def listHomes(self, after=None, limit=1000, server_name=None,
+                  status=None):
+        """ Get up to C{limit} homes with an id above C{after}, by id
+
+        @param server_name: only homes meant to be on that server
+        @param status: only homes with a state of that status
+        """
+        zs = getUtility(IZStorm).get("tilde")
+        conds = []
+        if after is not None:
+            conds.append(Home.id > after)
+        if server_name is not None:
+            conds.append(Home.server_name == server_name)
+        if status is not None:
+            conds.append(Home.id.is_in(
+                Select(HomeState.id, HomeState.status == status)))
+        res = zs.find(Home, *conds).order_by(Home.id)[:limit]
+        return [h.copy() for h in res]
+
     def create(self, home):
         res = defer.Deferred()
         log.info("creating home {0}".format(home))
@@ -176,42 +426,139 @@ class Updater(object):
             return Failure(Exception("Unable to get both servers"))
 
 
-        sync1 = source.sync(fromState=fromState, to=dest, home=home)
         if fromState.status == HomeState.ACTIVE:
-            # Active homes need to be archived then re-synced
+            # Active homes need to be archived then re-synced, copy as much
+            # as possible beforehand so the final sync has little left to do
+            sync1 = self._converge(source, dest, fromState, home)
             sync1.addCallback(lambda res: self.archive(fromState))
             sync1.addCallback(lambda res: self.refreshState(fromState))
             def _resync(newstate):
                 if newstate:
-                    return source.sync(fromState=newstate,
-                                       to=dest,
-                                       home=home)
+                    return self._sync(source, dest, newstate, home)
             sync1.addCallback(_resync)
 
+        else:
+            sync1 = self._sync(source, dest, fromState, home)
+
         return sync1
 
+    @defer.inlineCallbacks
+    def _converge(self, source, dest, fromState, home):
+        """ Sync C{fromState} to C{dest} until few changes are left """
+        clock = self.serverManager.reactor
+        for i in xrange(1, self.converge_passes + 1):
+            started = clock.seconds()
+            transferred = yield self._sync(source, dest, fromState, home)
+            elapsed = clock.seconds() - started
+            log.info("Sync pass %d of %s copied %s bytes in %.1fs",
+                     i, home, transferred, elapsed)
+
+            if (elapsed < self.converge_seconds or
+                    transferred is not None and (
+                        transferred == 0 or
+                        transferred < self.converge_bytes)):
+                break
+
+    def _sync(self, source, dest, fromState, home):
+        # Only the source runs a command, keep the destination open too
+        names = fromState.server_name, home.server_name
+        self.serverManager.hold(*names)
+
+        def _release(result):
+            self.serverManager.release(*names)
+            return result
+
+        lock = self.serverManager.syncLock(*names)
+        if lock is None:
+            d = self._trackedSync(source, dest, fromState, home)
+        else:
+            d = lock.run(self._trackedSync, source, dest, fromState, home)
+        return d.addBoth(_release)
+
+    def _trackedSync(self, source, dest, fromState, home):
+        """ Sync, keeping its progress in C{transfers} while it runs """
+        transfer = self.transfers[home.id] = {
+            "home_id": home.id,
+            "source": fromState.server_name,
+            "dest": home.server_name,
+            "path": home.path,
+            "started": time.time(),
+            "bytes": 0,
+            "percent": None,
+            "rate": None,
+            "eta": None,
+        }
+
+        def _done(result):
+            if self.transfers.get(home.id) is transfer:
+                del self.transfers[home.id]
+            return result
+
+        d = source.sync(fromState=fromState, to=dest, home=home,
+                        progress=transfer.update)
+        return d.addBoth(_done)
+
+    def getTransfers(self):
+        """ Progress of the syncs running now, slowest first """
+        return sorted(self.transfers.itervalues(),
+                      key=lambda t: t["rate"])
+
     @defer.inlineCallbacks
     def _find_free_path(self, server, path, status):
+        taken = yield self.findState(
+            HomeState.status == status,
+            HomeState.server_name == server,
+            HomeState.path.startswith(path))
+        taken = set(s.path for s in taken)
+
         newpath = path
         suffix = 0
-        while suffix < 10:
-            existing = yield self.findState(
-                HomeState.status == status,
-                HomeState.path == newpath,
-                HomeState.server_name == server)
-
-            if not existing:
-                defer.returnValue(newpath)
-
+        while newpath in taken:
             suffix += 1
             newpath = path + u"-{0}".format(suffix)
-        else:
-            raise Exception("Unable to find free archive path")
+
+        defer.returnValue(newpath)
+
+    def checkStates(self, states):
+        """ Check the paths of many C{states}, all those of a server at once
+
+        @return: a C{Deferred} firing with the path info of the states found,
+            by C{(id, server_name)}
+        """
+        byServer = {}
+        for s in states:
+            byServer.setdefault(s.server_name, []).append(s)
+
+        found = {}
+        def _check(name, states):
+            d = self.serverManager.getServer(name)
+            d.addCallback(lambda srv: srv.checkStatuses(states))
+
+            def _checked(results):
+                for state, (ok, info) in zip(states, results):
+                    if ok and info:
+                        found[state.id, state.server_name] = info
+
+            def _failed(reason):
+                # Each update checks its own states again
+                log.debug("Unable to check the states on %s: %s",
+                          name, reason.getErrorMessage())
+
+            return d.addCallbacks(_checked, _failed)
+
+        d = defer.gatherResults([_check(name, s)
+                                 for name, s in byServer.iteritems()])
+        return d.addCallback(lambda results: found)
 
     @defer.inlineCallbacks
-    def checkState(self, state):
-        srv = yield self.serverManager.getServer(state.server_name)
-        path_info = yield srv.checkStatus(state)
+    def checkState(self, state, path_info=None):
+        """ Get the path info of C{state}, clearing it when the path is gone
+
+        @param path_info: the info of the path, when already found
+        """
+        if path_info is None:
+            srv = yield self.serverManager.getServer(state.server_name)
+            path_info = yield srv.checkStatus(state)
         if path_info is None:
             log.info("Path %s doesn't exist, clearing", state)
             rmed = yield self.deleteState(state)
@@ -260,9 +607,16 @@ class Updater(object):
                 return defer.succeed("Nothing to do, already archived")
 
     @defer.inlineCallbacks
-    def updateOne(self, home, status):
+    def updateOne(self, home, status, found=None):
+        """ Bring C{home} up to date given its known C{status}
+
+        @param found: the path info of the states already found, by
+            C{(id, server_name)}, see L{checkStates}
+        """
+        found = found or {}
         checked_status = yield defer.gatherResults(
-            [self.checkState(s) for s in status],
+            [self.checkState(s, found.get((s.id, s.server_name)))
+             for s in status],
             consumeErrors=True
         )
 
@@ -285,51 +639,343 @@ class Updater(object):
         done = yield self._update(home, source)
 
 
+# Priority classes of updates, lowest first: cheap, user-facing creations go
+# before moves, then transfers between servers, then archives
+PRIORITY_CREATE = 0
+PRIORITY_MOVE = 1
+PRIORITY_MIGRATE = 2
+PRIORITY_ARCHIVE = 3
+
+def update_priority(home, status, found=None):
+    """ Priority class of the update of C{home} given its known C{status} """
+    if not home.active:
+        return PRIORITY_ARCHIVE
+    if not status:
+        return PRIORITY_CREATE
+    if all(s.server_name == home.server_name for s in status):
+        return PRIORITY_MOVE
+    return PRIORITY_MIGRATE
+
+def update_keys(home, status, found=None):
+    """ Servers, and transfers between them, an update of C{home} may use """
+    keys = set(s.server_name for s in status)
+    if home.server_name is not None:
+        keys.add(home.server_name)
+    if home.active:
+        keys.update((s.server_name, home.server_name)
+                    for s in status
+                    if s.server_name != home.server_name)
+    return keys
+
+
 class UpdaterService(service.Service):
-    def __init__(self, workers=1, interval=600):
+    """ Keeps homes up to date
+
+    Scans run every C{interval} seconds and feed a long-lived work queue,
+    they don't wait for the queued updates to be done. The queue never runs
+    two updates of the same home at once.
+
+    Updates that don't fit in the queue wait in it. With C{batch_size}, a
+    scan only lists more homes as the queue makes room for them, and the
+    next scans are skipped until it is done.
+
+    With C{warm_up}, connections to all servers are opened before the first
+    scan.
+    """
+    def __init__(self, workers=1, interval=600, full_scan_interval=0,
+                 listener=None, listen_delay=0.5, clock=None,
+                 batch_size=0, queue_size=1000, aging=600, warm_up=False):
         self.workers = workers
+        self.warm_up = warm_up
         self.interval = interval
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.aging = aging
+        self.full_scan_interval = full_scan_interval
         self.task = None
+        self.queue = None
+        # Scan in progress, and whether to scan again once it is done, see
+        # perform_task
+        self.scanning = None
+        self.rescan = False
+
+        # Incremental scan bookkeeping, see _scan
+        self.since = None
+        self.last_full_scan = None
+        self.retry = set()
+
+        # Push notifications, see homeChanged
+        self.listener = listener
+        self.listen_delay = listen_delay
+        self.notified = set()
+        self._dispatchCall = None
+
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+
+    def _needsFullScan(self, now):
+        return (not self.full_scan_interval or
+                self.since is None or
+                now - self.last_full_scan >= self.full_scan_interval)
+
+    def _updateOne(self, service, home, status, found=None):
+        def _failed(reason):
+            # Failed homes are not dirtied again, look at them next time
+            self.retry.add(home.id)
+            log_err(reason, log, "failed to update")
 
+        def _done(res):
+            if home.id in self.notified:
+                # Changed while we were busy with it
+                self._scheduleDispatch()
+            return res
+
+        return service.updateOne(home, status, found).addErrback(_failed
+                                                ).addBoth(_done)
+
+    def _makeScheduler(self, service):
+        return Scheduler(lambda *r: self._updateOne(service, *r),
+                         self.workers,
+                         self.queue_size,
+                         keys=update_keys,
+                         limit=service.serverManager.concurrencyLimit,
+                         priority=update_priority,
+                         aging=self.aging,
+                         ident=lambda home, *r: home.id,
+                         clock=self.clock)
+
+    def enqueue(self, servers):
+        """ Queue updates for a list of C{(home, states)}
+
+        @return: a C{Deferred} firing once they are all accepted
+        """
+        d = self._checked(servers)
+        return d.addCallback(self.queue.putAll)
+
+    def _checked(self, servers):
+        """ Check the paths of the states of C{servers} before queueing them
+
+        All the paths of a server are checked at once, the updates then
+        only check again those that weren't found.
+
+        @return: a C{Deferred} firing with the items to queue
+        """
+        servers = list(servers)
+        fresh = []
+        for home, status in servers:
+            if self.queue.isRunning(home.id):
+                # The update in progress may be working from older data
+                self.retry.add(home.id)
+            else:
+                fresh.append((home, status))
+
+        d = self.parent.updater.checkStates(
+            [s for home, status in fresh for s in status])
+
+        def _items(found):
+            return [(home, status, found) for home, status in fresh]
+        return d.addCallback(_items)
+
+    def homeChanged(self, payload):
+        """ Handle a notification carrying the id of a changed home """
+        try:
+            id = int(payload)
+        except (TypeError, ValueError):
+            log.warning("Ignoring unexpected notification %r", payload)
+        else:
+            self.parent.updater.homeChanged(id)
+            self.notified.add(id)
+            self._scheduleDispatch()
+
+    def _scheduleDispatch(self):
+        # Coalesce notifications arriving in a short burst
+        if self._dispatchCall is None:
+            self._dispatchCall = self.clock.callLater(self.listen_delay,
+                                                      self.dispatchNotified)
 
     @defer.inlineCallbacks
+    def dispatchNotified(self):
+        self._dispatchCall = None
+        # Homes being updated are dispatched again once they are done
+        ids = self.notified - self.queue.running
+        if not ids:
+            return
+        self.notified -= ids
+
+        log.debug("Updating notified homes %s", sorted(ids))
+        service = self.parent.updater
+        try:
+            servers = yield service.listSharesToUpdate(ids=sorted(ids))
+        except Exception:
+            self.retry.update(ids)
+            log_err(None, log, "failed to list notified homes")
+        else:
+            yield self.enqueue(servers)
+
     def perform_task(self):
-        log.debug("Starting run")
+        if self.scanning is not None:
+            log.info("Previous scan is still running, skipped")
+            return
+
+        # A failed scan must not stop the next ones
+        d = self.scanning = self._scan().addErrback(log_err, log,
+                                                    "failed to scan")
+
+        def _done(result):
+            self.scanning = None
+            if self.rescan:
+                self.rescan = False
+                self.clock.callLater(0, self.perform_task)
+        d.addBoth(_done)
+
+        # Streamed scans don't hold the next runs while waiting for room in
+        # the queue, those are skipped meanwhile
+        if not self.batch_size:
+            return d
+
+    def scanSoon(self):
+        """ Scan now, or once the scan in progress is done """
+        if self.scanning is None:
+            self.perform_task()
+        else:
+            self.rescan = True
+
+    def listening(self):
+        """ Handle the listener connecting, or reconnecting
+
+        The notifications sent until now were missed, a scan catches up
+        with the changes.
+        """
+        self.parent.updater.listening()
+        if self.task is not None:
+            self.scanSoon()
+
+    @defer.inlineCallbacks
+    def _scan(self):
         service = self.parent.updater
-        servers = yield service.listSharesToUpdate()
-        work = (
-            service.updateOne(*r).addErrback(log_err, log, "failed to update")
-            for r in servers
-        )
-        numworkers = self.workers
-        workers = [task.cooperate(work).whenDone()
-                   for i in xrange(numworkers)]
+        now = time.time()
+
+        watermark = None
+        if self.full_scan_interval:
+            watermark = yield service.getWatermark()
 
-        dl = yield defer.DeferredList(workers)
-        log.debug("Done")
+        full = self._needsFullScan(now)
+        if full:
+            log.debug("Starting full run")
+            since, ids = None, None
+        else:
+            log.debug("Starting run for changes since %s", self.since)
+            since, ids = self.since, list(self.retry)
+        # Homes failing from now on are retried by the next run
+        retry, self.retry = self.retry, set()
+
+        try:
+            if self.batch_size:
+                yield service.streamSharesToUpdate(self.enqueue,
+                                                   since, ids,
+                                                   self.batch_size)
+            else:
+                servers = yield service.listSharesToUpdate(since, ids)
+                items = yield self._checked(servers)
+                self.queue.putAll(items)
+        except Exception:
+            # Nothing was missed, the next run looks at the same homes
+            self.retry.update(retry)
+            raise
+
+        if full:
+            self.last_full_scan = now
+        self.since = watermark
+        log.debug("Done, %d updates running and %d queued",
+                  self.queue.active, len(self.queue))
 
     def startService(self):
         service.Service.startService(self)
+        self.queue = self._makeScheduler(self.parent.updater)
+        # Right away, the cache isn't used until it listens
+        if self.listener is not None:
+            self.listener.start(self.homeChanged, self.listening)
+        if self.warm_up:
+            d = self.parent.updater.serverManager.warmUp()
+            d.addCallback(lambda results: self._startTasks())
+        else:
+            self._startTasks()
+
+    def _startTasks(self):
+        if not self.running:
+            return
         self.task = task.LoopingCall(self.perform_task)
+        self.task.clock = self.clock
         self.task.start(self.interval)
 
     def stopService(self):
+        service.Service.stopService(self)
+        if self.listener is not None:
+            self.listener.stop()
+        if self.task is None:
+            return
         self.task.stop()
+        self.queue.close()
+        if self._dispatchCall is not None:
+            self._dispatchCall.cancel()
+            self._dispatchCall = None
 
 def getService(config, reactor=None, web=True):
+    if int(config.get("cache_size", 0)) and not config.get("listen"):
+        # Nothing would tell about homes changed by other writers
+        raise Exception("cache_size requires listen")
+
     if reactor is None:
         from twisted.internet import reactor
 
     root = service.MultiService()
 
-    sm = ServerManager(reactor, config["servers"])
+    sm = ServerManager(reactor, config["servers"],
+                       float(config.get("reconnect_delay", 1)),
+                       float(config.get("reconnect_max_delay", 300)),
+                       float(config.get("idle_timeout", 0)))
     smTrigId = reactor.addSystemEventTrigger("before", "shutdown", sm.loseConnections)
 
-    tp = reactor.getThreadPool()
-    root.updater = Updater(Transactor(tp), sm)
+    # Database work gets its own threads, each thread has its own store and
+    # connection, so their number bounds the connections to the database.
+    db_threads = max(int(config.get("db_threads", 10)), 1)
+    tp = ThreadPool(1, db_threads, "tilde-db")
+    reactor.callWhenRunning(tp.start)
+    reactor.addSystemEventTrigger("during", "shutdown", tp.stop)
+    transactor = Transactor(tp)
+    writer = None
+    if float(config.get("write_delay", 0)):
+        writer = StateWriter(transactor,
+                             float(config["write_delay"]),
+                             int(config.get("write_batch", 100)),
+                             reactor)
+    cache = None
+    if int(config.get("cache_size", 0)):
+        cache = HomeCache(int(config["cache_size"]))
+    root.updater = Updater(transactor, sm, writer,
+                           int(config.get("converge_passes", 1)),
+                           int(config.get("converge_bytes", 0)),
+                           float(config.get("converge_seconds", 0)),
+                           cache)
+
+    interval = int(config.get("interval", 300))
+    listener = None
+    if config.get("listen"):
+        listener = NotifyListener(reactor, config["dburl"], config["listen"])
+        # Notifications do the work, polling is only a safety net
+        interval = int(config.get("listen_interval", 3600))
 
     updater = UpdaterService(int(config.get("workers", 10)),
-                             int(config.get("interval", 300)),
+                             interval,
+                             int(config.get("full_scan_interval", 0)),
+                             listener,
+                             float(config.get("listen_delay", 0.5)),
+                             reactor,
+                             int(config.get("batch_size", 0)),
+                             int(config.get("queue_size", 1000)),
+                             int(config.get("priority_aging", 600)),
+                             bool(int(config.get("warm_up", 0))),
                             )
     root.addService(updater)
     updater.parent = root
@@ -348,14 +994,26 @@ def getService(config, reactor=None, web=True):
 @defer.inlineCallbacks
 def run(service, config):
     log.debug("Starting run")
-    servers = yield service.listSharesToUpdate()
-    work = (
-        service.updateOne(*r).addErrback(log_err, log, "failed to update")
-        for r in servers
+    scheduler = Scheduler(
+        lambda *r: service.updateOne(*r).addErrback(
+            log_err, log, "failed to update"),
+        int(config.get("workers", 10)) or 1,
+        int(config.get("queue_size", 1000)),
+        keys=update_keys,
+        limit=service.serverManager.concurrencyLimit,
+        priority=update_priority,
+        aging=int(config.get("priority_aging", 600)),
     )
-    numworkers = int(config.get("workers", 10)) or 1
-    workers = [task.cooperate(work).whenDone()
-               for i in xrange(numworkers)]
+    batch_size = int(config.get("batch_size", 0))
+    try:
+        if batch_size:
+            yield service.streamSharesToUpdate(scheduler.putAll,
+                                               batch_size=batch_size)
+        else:
+            servers = yield service.listSharesToUpdate()
+            scheduler.putAll(servers)
+    finally:
+        scheduler.close()
 
-    dl = yield defer.DeferredList(workers)
+    yield scheduler.whenDone()
     log.debug("Done")
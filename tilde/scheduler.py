@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+#
+# (C) Copyright Révolution Linux 2012
+#
+# Authors:
+# Vincent Vinet <vince.vinet@gmail.com>
+#
+# This file is part of tilde.
+#
+# tilde is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tilde is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tilde.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import itertools
+import logging
+log = logging.getLogger(__name__)
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from tilde.util import log_err
+
+
+class _Entry(object):
+    """ A queued item """
+    __slots__ = ("seq", "queued", "item", "ident", "keys", "priority",
+                 "deferred", "removed")
+
+    def __init__(self, seq, queued, item, ident, keys, priority):
+        self.seq = seq
+        self.queued = queued
+        self.item = item
+        self.ident = ident
+        self.keys = keys
+        self.priority = priority
+        self.deferred = None
+        self.removed = False
+
+
+class _Queue(object):
+    """ Entries grouped by the keys they hold, then by priority
+
+    Each group is kept in the order entries came in, and only the head of
+    each group is looked at to find the next entry. There are only as many
+    groups as combinations of keys and priorities in use, however many
+    entries are queued.
+    """
+
+    def __init__(self):
+        self.groups = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, entry):
+        group = (entry.keys, entry.priority)
+        if group not in self.groups:
+            self.groups[group] = collections.deque()
+        self.groups[group].append(entry)
+        self.count += 1
+
+    def discard(self, entry):
+        # Dropped from its group once it reaches the head
+        entry.removed = True
+        self.count -= 1
+
+    def pop(self, rank, eligible=None):
+        """ Remove the head ranking lowest among those whose keys are
+        C{eligible}, and return it
+        """
+        best = None
+        for group, queue in self.groups.items():
+            while queue and queue[0].removed:
+                queue.popleft()
+            if not queue:
+                del self.groups[group]
+            elif ((eligible is None or eligible(group[0])) and
+                    (best is None or rank(queue[0]) < rank(best[1][0]))):
+                best = group, queue
+
+        if best is None:
+            return None
+        group, queue = best
+        entry = queue.popleft()
+        while queue and queue[0].removed:
+            queue.popleft()
+        if not queue:
+            del self.groups[group]
+        self.count -= 1
+        return entry
+
+
+class Scheduler(object):
+    """ Runs queued work items with a fixed number of workers
+
+    Up to C{size} items are buffered, and L{put} returns a C{Deferred} that
+    fires once the item has been accepted, so producers are paced by the
+    workers instead of piling up items in memory.
+
+    Items can also be limited by the resources they use: C{keys} returns
+    the keys an item holds while it runs, and no item is started while one
+    of its keys is used by C{limit(key)} running items already. Items held
+    back that way are skipped in favour of the next ones.
+
+    Items are accepted and started by C{priority}, lowest first, then in
+    the order they came in. An item's priority improves by one for every
+    C{aging} seconds it has been waiting, so low priority work still gets
+    its turn.
+
+    When C{ident} is given, an item whose identity is already queued only
+    updates the queued arguments, along with their priority and keys, and
+    one whose identity is running is ignored: the same work never runs
+    twice at once.
+
+    @param process: callable run with each item's arguments, it may return
+        a C{Deferred}
+    @param workers: maximum number of items processed at once
+    @param size: maximum number of buffered items
+    @param keys: callable returning the keys for an item's arguments
+    @param limit: callable returning the limit for a key, C{None} or C{0}
+        for no limit
+    @param priority: callable returning the priority for an item's arguments
+    @param aging: seconds of waiting that make up for one priority level,
+        C{0} to never age
+    @param ident: callable returning the identity of an item's arguments
+    """
+
+    def __init__(self, process, workers=1, size=1000, keys=None, limit=None,
+                 priority=None, aging=0, ident=None, clock=None):
+        self.process = process
+        self.workers = max(workers, 1)
+        self.size = max(size, 1)
+        self.keys = keys
+        self.limit = limit
+        self.priority = priority
+        self.aging = aging
+        self.ident = ident
+
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+
+        # Buffered entries, and those waiting for room in the buffer
+        self.pending = _Queue()
+        self._putters = _Queue()
+        self.active = 0
+        self.busy = collections.defaultdict(int)
+        self.running = set()
+
+        self._seq = itertools.count()
+        self._queued = {}
+        self._closed = False
+        self._scheduling = False
+        self._waiting = []
+
+    def __len__(self):
+        return len(self.pending) + len(self._putters)
+
+    def put(self, item):
+        """ Queue C{item}, a tuple of arguments for C{process}
+
+        @return: a C{Deferred} firing when the item has been accepted
+        """
+        if self._closed:
+            return defer.fail(Exception("Scheduler is closed"))
+
+        ident = self._itemIdent(item)
+        if ident is not None:
+            if ident in self.running:
+                log.debug("%r is already running, ignored", ident)
+                return defer.succeed(None)
+            if ident in self._queued:
+                self._refresh(self._queued[ident], item)
+                return defer.succeed(None)
+
+        entry = _Entry(next(self._seq), self.clock.seconds(), item, ident,
+                       self._itemKeys(item), self._itemPriority(item))
+        if ident is not None:
+            self._queued[ident] = entry
+
+        if self._putters or len(self.pending) >= self.size:
+            d = entry.deferred = defer.Deferred()
+            self._putters.add(entry)
+            self._schedule()
+            return d
+
+        self.pending.add(entry)
+        self._schedule()
+        return defer.succeed(None)
+
+    def _refresh(self, entry, item):
+        """ Update a queued entry with the latest arguments """
+        keys, priority = self._itemKeys(item), self._itemPriority(item)
+        if (keys, priority) == (entry.keys, entry.priority):
+            # Keep its place
+            entry.item = item
+            return
+
+        # Move it where the new arguments belong, it keeps its age
+        queue = self.pending if entry.deferred is None else self._putters
+        queue.discard(entry)
+        moved = _Entry(next(self._seq), entry.queued, item, entry.ident,
+                       keys, priority)
+        moved.deferred = entry.deferred
+        self._queued[entry.ident] = moved
+        queue.add(moved)
+        self._schedule()
+
+    def isRunning(self, ident):
+        return ident in self.running
+
+    def putAll(self, items):
+        """ Queue all of C{items}, most urgent first
+
+        @return: a C{Deferred} firing when all items have been accepted
+        """
+        if self.priority is not None:
+            items = sorted(items, key=lambda item: self.priority(*item))
+        waiting = [d for d in (self.put(item) for item in items)
+                   if not d.called]
+        return defer.gatherResults(waiting)
+
+    def close(self):
+        """ Stop accepting items, L{whenDone} fires once all are processed """
+        self._closed = True
+        self._checkDone()
+
+    def whenDone(self):
+        d = defer.Deferred()
+        self._waiting.append(d)
+        self._checkDone()
+        return d
+
+    def _checkDone(self):
+        if self._closed and not self.active and not len(self):
+            waiting, self._waiting = self._waiting, []
+            for d in waiting:
+                d.callback(None)
+
+    def _itemIdent(self, item):
+        if self.ident is None:
+            return None
+        return self.ident(*item)
+
+    def _itemPriority(self, item):
+        if self.priority is None:
+            return 0
+        return self.priority(*item)
+
+    def _accept(self):
+        rank = self._rank(self.clock.seconds())
+        while self._putters and len(self.pending) < self.size:
+            entry = self._putters.pop(rank)
+            self.pending.add(entry)
+            d, entry.deferred = entry.deferred, None
+            d.callback(None)
+
+    def _rank(self, now):
+        """ Get the sort key of entries by priority, aged as of C{now} """
+        def rank(entry):
+            priority = entry.priority
+            if self.aging:
+                priority -= (now - entry.queued) / float(self.aging)
+            return priority, entry.seq
+        return rank
+
+    def _itemKeys(self, item):
+        if self.keys is None:
+            return ()
+        return tuple(sorted(set(self.keys(*item))))
+
+    def _eligible(self, keys):
+        if self.limit is None:
+            return True
+        for key in keys:
+            limit = self.limit(key)
+            if limit and self.busy[key] >= limit:
+                return False
+        return True
+
+    def _next(self):
+        """ Take the most urgent entry that can be started, if any """
+        rank = self._rank(self.clock.seconds())
+        entry = self.pending.pop(rank, self._eligible)
+        if entry is not None:
+            self._accept()
+            return entry
+
+        # Everything buffered is held back, look at what's waiting to get in
+        entry = self._putters.pop(rank, self._eligible)
+        if entry is not None:
+            d, entry.deferred = entry.deferred, None
+            d.callback(None)
+        return entry
+
+    def _schedule(self):
+        # Items may complete synchronously, which calls back in here
+        if self._scheduling:
+            return
+
+        self._scheduling = True
+        try:
+            while self.active < self.workers:
+                entry = self._next()
+                if entry is None:
+                    break
+                self._start(entry)
+        finally:
+            self._scheduling = False
+        self._checkDone()
+
+    def _start(self, entry):
+        for key in entry.keys:
+            self.busy[key] += 1
+        if entry.ident is not None:
+            self._queued.pop(entry.ident, None)
+            self.running.add(entry.ident)
+        self.active += 1
+        d = defer.maybeDeferred(self.process, *entry.item)
+        d.addBoth(self._finished, entry.keys, entry.ident)
+
+    def _finished(self, result, keys, ident):
+        self.active -= 1
+        self.running.discard(ident)
+        for key in keys:
+            self.busy[key] -= 1
+            if not self.busy[key]:
+                del self.busy[key]
+        if isinstance(result, Failure):
+            log_err(result, log, "Unhandled failure in scheduled work")
+        self._schedule()
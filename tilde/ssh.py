@@ -1,20 +1,21 @@
 import sys
 import os
 import struct
+import collections
 import logging
 log = logging.getLogger(__name__)
 
 
-from cStringIO import StringIO
-
 from twisted.python.failure import Failure
 from twisted.internet.error import (
     ProcessTerminated,
     ProcessDone,
     ConnectionDone,
+    ConnectionLost,
 )
 from twisted.internet.defer import Deferred, succeed, DeferredList
 from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.task import LoopingCall
 from twisted.internet.endpoints import TCP4ClientEndpoint
 
 from twisted.conch.ssh.common import NS, getNS
@@ -26,6 +27,10 @@ from twisted.conch.client.options import ConchOptions
 
 from tilde.util import log_err
 
+class CommandTimeout(Exception):
+    """ The command didn't complete in time and was killed """
+
+
 class RemoteCommandProtocol(Protocol):
     """
     Base class for protocols that execute commands remotely
@@ -53,10 +58,64 @@ class RemoteCommandProtocol(Protocol):
     def errReceived(self, bytes):
         """ Implement this to receive standard error """
 
+class CaptureBuffer(object):
+    """ Collects output, keeping only its start and end past C{size} bytes
+
+    @ivar written: number of bytes written so far
+    """
+    def __init__(self, size=None):
+        self.size = size
+        self.written = 0
+        if size is not None:
+            self._headMax = size // 2
+            self._tailMax = size - self._headMax
+        self._head = []
+        self._headSize = 0
+        self._tail = collections.deque()
+        self._tailSize = 0
+
+    def write(self, data):
+        self.written += len(data)
+        if self.size is None:
+            self._head.append(data)
+            return
+
+        room = self._headMax - self._headSize
+        if room > 0:
+            self._head.append(data[:room])
+            self._headSize += len(data[:room])
+            data = data[room:]
+
+        if data:
+            self._tail.append(data)
+            self._tailSize += len(data)
+            # Drop whole chunks, getvalue trims the rest
+            while (len(self._tail) > 1 and
+                   self._tailSize - len(self._tail[0]) >= self._tailMax):
+                self._tailSize -= len(self._tail.popleft())
+
+    def getvalue(self):
+        head = "".join(self._head)
+        if self.size is None:
+            return head
+
+        tail = "".join(self._tail)
+        tail = tail[max(len(tail) - self._tailMax, 0):]
+        skipped = self.written - len(head) - len(tail)
+        if not skipped:
+            return head + tail
+        return "{0}\n[... {1} bytes skipped ...]\n{2}".format(
+            head, skipped, tail)
+
+
 class RunCommandProtocol(RemoteCommandProtocol):
-    def __init__(self):
-        self.out = StringIO()
-        self.err = StringIO()
+    """ Collects the command's output in C{out} and C{err}
+
+    @param capture: bytes of each output kept, C{None} keeps everything
+    """
+    def __init__(self, capture=None):
+        self.out = CaptureBuffer(capture)
+        self.err = CaptureBuffer(capture)
 
     def dataReceived(self, bytes):
         self.out.write(bytes)
@@ -65,6 +124,19 @@ class RunCommandProtocol(RemoteCommandProtocol):
         self.err.write(bytes)
 
 
+class InputCommandProtocol(RunCommandProtocol):
+    """ Feeds C{input} to the command's standard input, then closes it """
+    def __init__(self, input, capture=None):
+        RunCommandProtocol.__init__(self, capture)
+        if isinstance(input, unicode):
+            input = input.encode('utf-8')
+        self.input = input
+
+    def connectionMade(self):
+        self.transport.write(self.input)
+        self.transport.conn.sendEOF(self.transport)
+
+
 class StdoutEcho(RemoteCommandProtocol):
     def dataReceived(self, bytes):
         sys.stdout.write(bytes)
@@ -76,6 +148,8 @@ class SSHServer(object):
                  hostname="localhost",
                  port=22,
                  user=None,
+                 keepalive_interval=None,
+                 keepalive_count=3,
                 ):
         self._reactor = reactor
         self._hostname = hostname
@@ -84,6 +158,26 @@ class SSHServer(object):
             user = os.environ['USER']
         self.user = str(user)
         self.connection = None
+        # Seconds between keepalives, and how many can go unanswered before
+        # the connection is considered dead
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        self._lostCallbacks = []
+
+    def notifyOnLost(self, callback):
+        """ Call C{callback} with the reason once the connection is lost """
+        self._lostCallbacks.append(callback)
+
+    def _connectionLost(self, reason):
+        log.warning("Lost connection to %s: %s",
+                    self._hostname, reason.getErrorMessage())
+        self.connection = None
+        callbacks, self._lostCallbacks = self._lostCallbacks, []
+        for callback in callbacks:
+            try:
+                callback(reason)
+            except Exception:
+                log_err(None, log, "Error in lost connection callback")
 
     def connect(self):
         tcpEndpoint = TCP4ClientEndpoint(self._reactor,
@@ -100,17 +194,181 @@ class SSHServer(object):
 
         return factory.serverConnected
 
-    def runCommand(self, command, protocol=RemoteCommandProtocol):
-        p = protocol()
-        p.finished = Deferred()
-        p.finished.addErrback(lambda reason: reason.trap(ProcessDone))
+    def loseConnection(self):
+        if self.connection is not None:
+            self.connection.loseConnection()
+
+    def runCommand(self, command, protocol=RemoteCommandProtocol,
+                   timeout=None):
+        """ Run C{command} in a new channel
+
+        @param timeout: seconds after which the command is killed and its
+            C{finished} fails with L{CommandTimeout}, C{None} to wait forever
+        @return: the C{protocol} instance
+        """
+        p = _makeProtocol(protocol)
+        self._runCommand(command, p, timeout=timeout)
+        return p
+
+    def _runCommand(self, command, p, onClose=None, timeout=None):
+        """ Run C{command} with the protocol instance C{p}
 
-        channel = _CommandChannel(command, p)
+        @param onClose: called once the channel is closed, or couldn't open
+        """
+        if self.connection is None:
+            p.finished.errback(ConnectionLost(
+                "Not connected to {0}".format(self._hostname)))
+            if onClose is not None:
+                onClose()
+            return
+
+        channel = _CommandChannel(command, p, onClose, timeout)
         d = self.connection.requestChannel(channel)
 
-        d.addErrback(p.finished.errback)
+        d.addErrback(channel._cancelled)
+
+
+def _makeProtocol(protocol):
+    p = protocol()
+    p.finished = Deferred()
+    p.finished.addErrback(lambda reason: reason.trap(ProcessDone))
+    return p
+
+
+class SSHServerPool(object):
+    """ Several connections to the same server
+
+    Each command gets its own channel on the connection with the fewest
+    open ones. When all connections already have C{max_sessions} channels
+    open, commands wait for one to close instead of having the server
+    refuse the channel.
+
+    When a connection is lost the whole pool is reported lost, so a new one
+    gets opened, and its other connections are closed once idle.
+    """
+    def __init__(self,
+                 reactor,
+                 hostname="localhost",
+                 port=22,
+                 user=None,
+                 connections=1,
+                 max_sessions=10,
+                 **kw):
+        self._reactor = reactor
+        self._hostname = hostname
+        self.max_sessions = max_sessions
+        self._lastActive = reactor.seconds()
+        self.members = [
+            SSHServer(reactor, hostname, port, user, **kw)
+            for i in range(max(connections, 1))
+        ]
+        self.sessions = dict((member, 0) for member in self.members)
+        self._waiting = collections.deque()
+        self._lost = False
+        self._lostCallbacks = []
+
+    def connect(self):
+        d = DeferredList([member.connect() for member in self.members],
+                         consumeErrors=True)
+        d.addCallback(self._connected)
+        return d
+
+    def _connected(self, results):
+        failures = []
+        for (success, result), member in zip(results, self.members):
+            if success:
+                member.notifyOnLost(
+                    lambda reason, member=member:
+                        self._memberLost(reason, member))
+            else:
+                log.warning("Unable to open a connection to %s: %s",
+                            self._hostname, result.getErrorMessage())
+                failures.append(result)
+                del self.sessions[member]
+
+        self.members = [member for member in self.members
+                        if member in self.sessions]
+        if not self.members:
+            return failures[0]
+        return self
+
+    def notifyOnLost(self, callback):
+        """ Call C{callback} with the reason once a connection is lost """
+        self._lostCallbacks.append(callback)
+
+    def _memberLost(self, reason, member):
+        self.members.remove(member)
+        del self.sessions[member]
+
+        if not self.members:
+            waiting, self._waiting = self._waiting, collections.deque()
+            for command, p, timeout in waiting:
+                p.finished.errback(ConnectionLost(
+                    "Not connected to {0}".format(self._hostname)))
+
+        if not self._lost:
+            self._lost = True
+            for member in list(self.members):
+                if not self.sessions[member]:
+                    member.loseConnection()
+            callbacks, self._lostCallbacks = self._lostCallbacks, []
+            for callback in callbacks:
+                callback(reason)
+
+    def loseConnection(self):
+        for member in list(self.members):
+            member.loseConnection()
+
+    def idleSince(self, sessions=0):
+        """ When the last command completed, or C{None} if some are running
+
+        @param sessions: commands kept running on purpose, that don't count
+        """
+        if self._waiting or sum(self.sessions.itervalues()) > sessions:
+            return None
+        return self._lastActive
+
+    def runCommand(self, command, protocol=RemoteCommandProtocol,
+                   timeout=None):
+        """ Same as L{SSHServer.runCommand}, the timeout only starts once
+        the command got a channel
+        """
+        p = _makeProtocol(protocol)
+        if not self.members:
+            p.finished.errback(ConnectionLost(
+                "Not connected to {0}".format(self._hostname)))
+        else:
+            self._waiting.append((command, p, timeout))
+            self._dispatch()
         return p
 
+    def _dispatch(self):
+        while self._waiting and self.members:
+            member = min(self.members, key=self.sessions.get)
+            if self.max_sessions and self.sessions[member] >= self.max_sessions:
+                log.debug("All sessions to %s in use, %d commands waiting",
+                          self._hostname, len(self._waiting))
+                break
+
+            command, p, timeout = self._waiting.popleft()
+            self.sessions[member] += 1
+            member._runCommand(command, p, self._closer(member), timeout)
+
+    def _closer(self, member):
+        closed = []
+
+        def _closed():
+            if closed:
+                return
+            closed.append(True)
+            self._lastActive = self._reactor.seconds()
+            if member in self.sessions:
+                self.sessions[member] -= 1
+                if self._lost and not self.sessions[member]:
+                    member.loseConnection()
+            self._dispatch()
+        return _closed
+
 
 class SSHTransport(SSHClientTransport):
     _secured = False
@@ -127,12 +385,16 @@ class SSHTransport(SSHClientTransport):
         self.requestService(userauth)
 
     def connectionLost(self, reason):
-        if not self._secured:
-            self.factory.commandConnected.errback(reason)
+        SSHClientTransport.connectionLost(self, reason)
+        # Lost before the connection service started, even once secured
+        if not self.factory.serverConnected.called:
+            self.factory.serverConnected.errback(reason)
 
 
 class _CommandConnection(SSHConnection):
     _ready = False
+    _keepalive = None
+    _missed = 0
 
     def __init__(self, factory):
         SSHConnection.__init__(self)
@@ -148,17 +410,46 @@ class _CommandConnection(SSHConnection):
         else:
             del self._pendingChannelsDeferreds[:]
 
-        self.factory.server.connection = self
+        server = self.factory.server
+        server.connection = self
+        if server.keepalive_interval:
+            self._keepalive = LoopingCall(self._sendKeepalive)
+            self._keepalive.clock = server._reactor
+            self._keepalive.start(server.keepalive_interval, now=False)
         self.factory.serverConnected.callback(self)
 
+    def _sendKeepalive(self):
+        if self._missed >= self.factory.server.keepalive_count:
+            log.warning("No keepalive reply from %s, dropping the connection",
+                        self.factory.server._hostname)
+            self._keepalive.stop()
+            self._keepalive = None
+            # A dead peer would never acknowledge a clean close
+            self.transport.transport.abortConnection()
+            return
+
+        self._missed += 1
+        d = self.sendGlobalRequest('keepalive@openssh.com', '', wantReply=1)
+        # Servers refuse the request, but any reply shows they are alive
+        d.addBoth(self._keepaliveReply)
+
+    def _keepaliveReply(self, result):
+        self._missed = 0
+
     def serviceStopped(self):
+        if self._keepalive is not None:
+            self._keepalive.stop()
+            self._keepalive = None
         for d, channel in self._pendingChannelsDeferreds:
             d.cancel()
         else:
             del self._pendingChannelsDeferreds[:]
-        self._ready = False
+        wasReady, self._ready = self._ready, False
 
         SSHConnection.serviceStopped(self)
+        server = self.factory.server
+        if wasReady and server.connection is self:
+            server._connectionLost(Failure(ConnectionLost()))
 
     def requestChannel(self, channel):
         ''' Request that a channel be opened when the service is started
@@ -184,19 +475,69 @@ class _CommandConnection(SSHConnection):
 class _CommandChannel(SSHChannel):
     name = 'session'
 
-    def __init__(self, command, protocol):
+    _timeoutCall = None
+    _expired = False
+
+    def __init__(self, command, protocol, onClose=None, timeout=None):
         SSHChannel.__init__(self)
         if isinstance(command, unicode):
             command = command.encode('utf-8')
         self._command = command
         self._protocol = protocol
+        self._onClose = onClose
+        self._timeout = timeout
+
+    def _timedOut(self):
+        self._timeoutCall = None
+        self._expired = True
+        log.warning("Killing '%s' after %ss", self._command, self._timeout)
+        try:
+            self.conn.sendRequest(self, 'signal', NS('KILL'))
+        except Exception:
+            log_err(None, log, "Unable to signal " + self._command)
+        self._protocol.connectionLost(Failure(CommandTimeout(
+            "'{0}' timed out after {1}s".format(self._command,
+                                                self._timeout))))
+        self.loseConnection()
+
+    def _cancelTimeout(self):
+        if self._timeoutCall is not None:
+            self._timeoutCall.cancel()
+            self._timeoutCall = None
+
+    def _notifyClosed(self):
+        self._cancelTimeout()
+        onClose, self._onClose = self._onClose, None
+        if onClose is not None:
+            onClose()
+
+    def _cancelled(self, reason):
+        # The connection went away before the channel could be requested
+        self._protocol.finished.errback(reason)
+        self._notifyClosed()
 
     def channelOpen(self, ignored):
         log.info('exec ' + self._command)
         self.conn.sendRequest(self, 'exec', NS(self._command))
+        if self._timeout:
+            clock = self.conn.factory.server._reactor
+            self._timeoutCall = clock.callLater(self._timeout, self._timedOut)
         self._protocol.makeConnection(self)
 
+    def openFailed(self, reason):
+        self._protocol.connectionLost(Failure(reason))
+        self._notifyClosed()
+
+    def closed(self):
+        # Fires finished if the connection went away before the command
+        # could report its exit status
+        self._protocol.connectionLost(Failure(ConnectionLost()))
+        self._notifyClosed()
+
     def request_exit_signal(self, data):
+        self._cancelTimeout()
+        if self._expired:
+            return
         signame, rest = getNS(data)
         core_dumped = struct.unpack('>?', rest[0])[0]
         msg, lang, rest = getNS(rest[1:], 2)
@@ -204,6 +545,9 @@ class _CommandChannel(SSHChannel):
             Failure(ProcessTerminated(signal=signame, status=msg)))
 
     def request_exit_status(self, data):
+        self._cancelTimeout()
+        if self._expired:
+            return
         stat = struct.unpack('>L', data)[0]
         if stat:
             res = ProcessTerminated(exitCode=stat)
@@ -1,11 +1,12 @@
 import os
+import re
 
 from twisted.python import log
 from twisted.internet import defer
 from zope.interface import implements
 from storm.zope.zstorm import IZStorm
 
-from tilde import core, models
+from tilde import core, models, ssh
 
 
 class MockZStorm(object):
@@ -41,24 +42,50 @@ class MockStore(object):
         log.msg("DB get {0}: {1}".format(cls, key, res))
         return res
 
+    def _value(self, obj, expr):
+        try:
+            return getattr(obj, expr.name)
+        except AttributeError:
+            return expr.get()
+
+    def _match(self, obj, c):
+        if c.oper == " = ":
+            return self._value(obj, c.expr1) == self._value(obj, c.expr2)
+        elif c.oper == " > ":
+            return self._value(obj, c.expr1) > self._value(obj, c.expr2)
+        elif c.oper == " AND ":
+            return all(self._match(obj, e) for e in c.exprs)
+        elif c.oper == " OR ":
+            return any(self._match(obj, e) for e in c.exprs)
+        elif c.oper == " IN ":
+            return (self._value(obj, c.expr1) in
+                    [self._value(obj, e) for e in c.expr2])
+        elif c.oper == " LIKE ":
+            pattern = c.expr2
+            if not isinstance(pattern, unicode):
+                pattern = pattern.get()
+            regex = ""
+            chars = iter(pattern)
+            for char in chars:
+                if char == c.escape:
+                    regex += re.escape(next(chars))
+                elif char == "%":
+                    regex += ".*"
+                elif char == "_":
+                    regex += "."
+                else:
+                    regex += re.escape(char)
+            value = self._value(obj, c.expr1)
+            return value is not None and re.match(regex + "$", value)
+
+        raise Exception("Can't test this")
+
     def find(self, cls, *cond):
-        def _m(obj):
-            for c in cond:
-                if c.oper != " = ":
-                    raise Exception("Can't test this")
-                vals = []
-                for v in (c.expr1, c.expr2):
-                    try:
-                        vals.append(getattr(obj, v.name))
-                    except AttributeError:
-                        vals.append(v.get())
-                if vals[0] != vals[1]: return False
-
-            return True
-
-        res = [val
-               for val in self.objects.get(cls, {}).itervalues()
-               if _m(val)]
+        res = MockResultSet(
+            self,
+            [val
+             for val in self.objects.get(cls, {}).itervalues()
+             if all(self._match(val, c) for c in cond)])
         log.msg("DB find {0} : {1} -> {2}".format(cls, cond, res))
         return res
 
@@ -81,6 +108,20 @@ class MockStore(object):
         self.objects.get(cls, {}).pop(key)
 
 
+class MockResultSet(list):
+    def __init__(self, store, objects):
+        list.__init__(self, objects)
+        self.store = store
+
+    def remove(self):
+        for obj in self:
+            self.store.remove(obj)
+
+    def order_by(self, column):
+        return MockResultSet(
+            self.store, sorted(self, key=lambda obj: getattr(obj, column.name)))
+
+
 class MockServerManager(core.ServerManager):
     def _makeUpdater(self, server, config):
         return MockShareUpdater(server, config)
@@ -89,14 +130,50 @@ class MockServerManager(core.ServerManager):
         return defer.succeed(MockSSHServer())
 
 class MockSSHServer(object):
+    def __init__(self):
+        self.connection = self
+        self._lostCallbacks = []
+        self.idle_since = 0
+        self.closed = False
+
+    def idleSince(self):
+        return self.idle_since
+
+    def notifyOnLost(self, callback):
+        self._lostCallbacks.append(callback)
+
+    def lose(self, reason=None):
+        ''' Fake a lost connection '''
+        self.connection = None
+        for callback in self._lostCallbacks:
+            callback(reason)
+
     def loseConnection(self):
         ''' Fake disconnect '''
+        self.closed = True
+
+
+class FakeCommandServer(object):
+    """ Records commands instead of running them """
+    def __init__(self):
+        self.commands = []
+
+    def runCommand(self, command, protocol=ssh.RemoteCommandProtocol,
+                   timeout=None):
+        p = protocol()
+        p.finished = defer.Deferred()
+        p.timeout = timeout
+        self.commands.append((command, p))
+        return p
 
 
 class MockShareUpdater(core.ShareUpdater):
     def __init__(self, *a):
         core.ShareUpdater.__init__(self, *a)
         self.known_paths = set("/")
+        # Status synced from, and bytes each sync reports copying
+        self.syncs = []
+        self.transfers = []
 
 
     def _make_parent(self, path):
@@ -126,7 +203,7 @@ class MockShareUpdater(core.ShareUpdater):
         self.known_paths.add(path)
         return defer.succeed(True)
 
-    def sync(self, fromState, to, home, bwlimit=None):
+    def sync(self, fromState, to, home, bwlimit=None, progress=None):
         assert isinstance(to, MockShareUpdater), "Don't want to accidently"
 
         if fromState.status == models.HomeState.ACTIVE:
@@ -139,9 +216,12 @@ class MockShareUpdater(core.ShareUpdater):
         log.msg("[{0.name}] SYNC {1!r} -> {2!r} [{3.name}]"
                 .format(self, sourcepath, to_path, to))
 
+        self.syncs.append(fromState.status)
         d = to._make_parent(to_path)
         def _then(*r):
             to.known_paths.add(to_path)
+            if self.transfers:
+                return self.transfers.pop(0)
 
         d.addBoth(_then)
         return d
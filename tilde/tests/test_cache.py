@@ -0,0 +1,76 @@
+from twisted.trial import unittest
+
+from tilde.cache import HomeCache
+from tilde.models import Home
+
+
+def makeHome(id, uuid=None):
+    home = Home()
+    home.id = id
+    home.uuid = uuid
+    home.path = u"/home{0}".format(id)
+    return home
+
+
+class HomeCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = HomeCache(2)
+
+    def test_lookups(self):
+        self.cache.putUUID(u"a", [makeHome(1, u"a")])
+        self.assertEquals(u"/home1", self.cache.get(1).path)
+        self.assertEquals([1], [h.id for h in self.cache.getByUUID(u"a")])
+        self.assertIs(None, self.cache.get(2))
+        self.assertIs(None, self.cache.getByUUID(u"b"))
+        self.assertEquals((2, 2), (self.cache.hits, self.cache.misses))
+
+        # Only complete lookups answer by uuid
+        self.cache.put(makeHome(2, u"b"))
+        self.assertIs(None, self.cache.getByUUID(u"b"))
+
+        # Copies are handed out
+        self.cache.get(1).path = u"/changed"
+        self.assertEquals(u"/home1", self.cache.get(1).path)
+
+    def test_shared_uuid(self):
+        self.cache.putUUID(u"a", [makeHome(1, u"a"), makeHome(2, u"a")])
+        self.assertEquals([1, 2], [h.id for h in self.cache.getByUUID(u"a")])
+
+        # A change to any of them drops the lookup
+        self.cache.invalidate(2)
+        self.assertIs(None, self.cache.getByUUID(u"a"))
+        self.assertEquals(1, self.cache.get(1).id)
+
+        # So does a home that may have joined them
+        self.cache.putUUID(u"a", [makeHome(1, u"a")])
+        self.cache.invalidate(3, uuids=True)
+        self.assertIs(None, self.cache.getByUUID(u"a"))
+        self.cache.putUUID(u"a", [makeHome(1, u"a")])
+        self.cache.put(makeHome(3, u"a"))
+        self.assertIs(None, self.cache.getByUUID(u"a"))
+
+    def test_lru(self):
+        self.cache.putUUID(u"a", [makeHome(1, u"a")])
+        self.cache.putUUID(u"b", [makeHome(2, u"b")])
+        self.cache.get(1)
+        self.cache.put(makeHome(3, u"c"))
+
+        self.assertEquals(2, len(self.cache))
+        self.assertIs(None, self.cache.get(2))
+        self.assertIs(None, self.cache.getByUUID(u"b"))
+        self.assertEquals(1, self.cache.get(1).id)
+
+    def test_invalidate(self):
+        self.cache.putUUID(u"a", [makeHome(1, u"a")])
+        self.cache.invalidate(1)
+        self.assertIs(None, self.cache.get(1))
+        self.assertIs(None, self.cache.getByUUID(u"a"))
+
+    def test_stale_read(self):
+        token = self.cache.token()
+        self.cache.invalidate(1)
+        self.cache.put(makeHome(1), token)
+        self.assertIs(None, self.cache.get(1))
+
+        self.cache.put(makeHome(1), self.cache.token())
+        self.assertEquals(1, self.cache.get(1).id)
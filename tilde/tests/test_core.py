@@ -1,16 +1,23 @@
 from __future__ import unicode_literals
 
+import json
+
 from twisted.python import log
 
 from twisted.trial import unittest
-from twisted.internet import reactor, defer
+from twisted.application import service
+from twisted.internet import reactor, defer, task
 from twisted.python.threadpool import ThreadPool
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
 from storm.twisted.transact import Transactor
+from storm.databases.postgres import compile
 
 from zope.component import getGlobalSiteManager
 GSM = getGlobalSiteManager()
 
 from .mock import (
+    FakeCommandServer,
     MockStore,
     MockZStorm,
     MockServerManager,
@@ -18,8 +25,28 @@ from .mock import (
 
 from tilde.models import Home, HomeState
 from tilde.loader import Server
-from tilde.runner import Updater
-from tilde.core import UnknownServer
+from tilde.runner import (
+    getService,
+    Updater,
+    UpdaterService,
+    update_priority,
+    PRIORITY_CREATE,
+    PRIORITY_MOVE,
+    PRIORITY_MIGRATE,
+    PRIORITY_ARCHIVE,
+)
+from tilde.core import (
+    UnknownServer,
+    ServerUnavailable,
+    ShareUpdater,
+    RsyncProtocol,
+    rsync_transferred,
+)
+from tilde.writer import StateWriter
+from tilde.cache import HomeCache
+from tilde.commands import ubuntu
+from tilde.agent import AgentError
+from tilde.ssh import CommandTimeout
 
 SERVERS = {
     "foo" : Server("foo", "/data/homes", archive_root="/data/archive"),
@@ -124,6 +151,39 @@ class UpdateTest(unittest.TestCase):
         self.assertIn("/data/archive/foo", fooserv.known_paths)
         self.assertNotIn("/data/homes/foo", fooserv.known_paths)
 
+    @defer.inlineCallbacks
+    def test_archive_taken_paths(self):
+        home = self._H(
+            server_name = "foo",
+            path = None,
+        )
+
+        status = self._S(
+            id = home.id,
+            server_name = "foo",
+            path = "/foo",
+            status = HomeState.ACTIVE,
+        )
+
+        for suffix in [""] + ["-{0}".format(i) for i in xrange(1, 12)]:
+            other = self._H(server_name=None, path=None)
+            self._S(
+                id = other.id,
+                server_name = "foo",
+                path = "/foo" + suffix,
+                status = HomeState.ARCHIVED,
+            )
+
+        fooserv = yield self.sm.getServer("foo")
+        fooserv.known_paths.add("/data/homes/foo")
+
+        done = yield self.updater.updateOne(home, [status])
+
+        status = self.db.objects[HomeState][(home.id, "foo")]
+        self.assertEquals(status.status, HomeState.ARCHIVED)
+        self.assertEquals(status.path, "/foo-12")
+        self.assertIn("/data/archive/foo-12", fooserv.known_paths)
+
     @defer.inlineCallbacks
     def test_sync(self):
         home = self._H(
@@ -156,6 +216,113 @@ class UpdateTest(unittest.TestCase):
         self.assertIn("/data/homes/foo", fooserv.known_paths)
         self.assertNotIn("/data/homes/bar", barserv.known_paths)
 
+    def test_sync_holds_servers(self):
+        home = self._H(server_name="foo", path="/foo")
+        status = self._S(id=home.id, server_name="bar", path="/bar",
+                         status=HomeState.ARCHIVED)
+
+        syncing = defer.Deferred()
+        source = self.successResultOf(self.sm.getServer("bar"))
+        source.sync = lambda **kw: syncing
+        dest = self.successResultOf(self.sm.getServer("foo"))
+
+        self.updater._sync(source, dest, status, home)
+        self.assertEquals({"foo": 1, "bar": 1}, self.sm._held)
+        syncing.callback(None)
+        self.assertEquals({}, self.sm._held)
+
+    @defer.inlineCallbacks
+    def test_lookup_homes(self):
+        homes = [self._H(server_name="foo", path="/h", uuid=u"u{0}".format(i))
+                 for i in range(4)]
+        state = self._S(id=homes[1].id, server_name="foo", path="/h",
+                        status=HomeState.ACTIVE)
+
+        found = yield self.updater.lookupHomes([homes[0].id], [u"u1"])
+        self.assertEquals(set([homes[0].id, homes[1].id]),
+                          set(h.id for h in found))
+
+        found = yield self.updater.lookupHomes(uuids=[u"u1", u"u2"],
+                                               states=True)
+        found = dict((h.id, s) for h, s in found)
+        self.assertEquals([state.server_name],
+                          [s.server_name for s in found[homes[1].id]])
+        self.assertEquals([], found[homes[2].id])
+
+        found = yield self.updater.lookupHomes()
+        self.assertEquals([], found)
+
+    @defer.inlineCallbacks
+    def test_cached_lookups(self):
+        self.updater.cache = HomeCache(10)
+        home = self._H(server_name="foo", path="/h", uuid=u"u1")
+
+        # Not cached before changes are listened to
+        found = yield self.updater.findHomeByUUID(u"u1")
+        self.assertEquals(0, len(self.updater.cache))
+        self.updater.listening()
+
+        found = yield self.updater.findHomeByUUID(u"u1")
+        self.assertEquals([home.id], [h.id for h in found])
+        self.db.objects[Home].clear()
+        found = yield self.updater.findHomeById(home.id)
+        self.assertEquals([home.id], [h.id for h in found])
+
+        # Gone once its state is written
+        yield self.updater.updateState(HomeState.fromHome(home))
+        found = yield self.updater.findHomeById(home.id)
+        self.assertEquals([], found)
+
+    @defer.inlineCallbacks
+    def test_cached_shared_uuid(self):
+        self.updater.cache = HomeCache(10)
+        self.updater.listening()
+        first = self._H(server_name="foo", path="/h1", uuid=u"u1")
+        found = yield self.updater.findHomeByUUID(u"u1")
+        self.assertEquals([first.id], [h.id for h in found])
+
+        # Added by someone else with the same uuid
+        second = self._H(server_name="foo", path="/h2", uuid=u"u1")
+        self.updater.homeChanged(second.id)
+        found = yield self.updater.findHomeByUUID(u"u1")
+        self.assertEquals(sorted([first.id, second.id]),
+                          sorted(h.id for h in found))
+
+    @defer.inlineCallbacks
+    def test_list_homes(self):
+        homes = [self._H(server_name=name, path="/h")
+                 for name in ("foo", "bar", "foo", "foo")]
+
+        listed = yield self.updater.listHomes(limit=2, server_name="foo")
+        self.assertEquals([homes[0].id, homes[2].id], [h.id for h in listed])
+        listed = yield self.updater.listHomes(after=homes[2].id)
+        self.assertEquals([homes[3].id], [h.id for h in listed])
+
+    @defer.inlineCallbacks
+    def test_sync_converge(self):
+        self.updater.converge_passes = 5
+        self.updater.converge_bytes = 100
+        home = self._H(server_name="foo", path="/foo")
+        status = self._S(
+            id=home.id,
+            server_name="bar",
+            path="/bar",
+            status=HomeState.ACTIVE,
+        )
+
+        barserv = yield self.sm.getServer("bar")
+        barserv.known_paths.add("/data/homes/bar")
+        barserv.transfers = [1000, 500, 50, 10]
+
+        done = yield self.updater.updateOne(home, [status])
+
+        # Synced while active until a pass copies little, then once archived
+        self.assertEquals([HomeState.ACTIVE] * 3 + [HomeState.ARCHIVED],
+                          barserv.syncs)
+        self.assertEquals([], self.updater.getTransfers())
+        status = self.db.objects[HomeState][(home.id, "foo")]
+        self.assertEquals(status.status, HomeState.ACTIVE)
+
     @defer.inlineCallbacks
     def test_sync_missing_source(self):
         home = self._H(
@@ -329,3 +496,645 @@ class UpdateTest(unittest.TestCase):
         self.assertNotIn("/data/homes/bar", barserv.known_paths)
         self.assertNotIn((home.id, "bar"), self.db.objects[HomeState])
         self.assertIn((home.id, "baz"), self.db.objects[HomeState])
+
+
+class BatchedUpdateTest(UpdateTest):
+    """ Same updates, with state changes going through a StateWriter """
+    def setUp(self):
+        UpdateTest.setUp(self)
+        self.updater.writer = StateWriter(self.updater.transactor, delay=0)
+
+    @defer.inlineCallbacks
+    def test_grouped_writes(self):
+        runs = []
+        run = self.updater.transactor.run
+        def _run(*a, **kw):
+            runs.append(a)
+            return run(*a, **kw)
+        self.updater.transactor.run = _run
+
+        home = self._H(server_name="foo", path="/a")
+        s1 = self._S(id=home.id, server_name="bar", path="/a",
+                     status=HomeState.ACTIVE)
+        s2 = HomeState.fromHome(home)
+
+        yield defer.gatherResults([
+            self.updater.updateState(s2),
+            self.updater.deleteState(s1),
+        ])
+
+        self.assertEquals(1, len(runs))
+        self.assertIn((home.id, "foo"), self.db.objects[HomeState])
+        self.assertNotIn((home.id, "bar"), self.db.objects[HomeState])
+
+    @defer.inlineCallbacks
+    def test_delete_home(self):
+        home = self._H(server_name="foo", path="/a")
+        self._S(id=home.id, server_name="foo", path="/a",
+                status=HomeState.ACTIVE)
+        self._S(id=home.id, server_name="bar", path="/a",
+                status=HomeState.ARCHIVED)
+
+        yield self.updater.deleteHome(home)
+
+        self.assertEquals({}, self.db.objects[HomeState])
+        self.assertEquals({}, self.db.objects[Home])
+
+
+class ListingTest(unittest.TestCase):
+    def test_pages(self):
+        updater = Updater(None, None)
+        select = compile(updater._dirtyHomes(None, None, after=5, limit=10))
+        self.assertIn("WHERE tilde_home.id > ?", select)
+        self.assertTrue(select.endswith("ORDER BY tilde_home.id LIMIT 10"))
+
+        select = compile(updater._dirtyHomes(None, None))
+        self.assertNotIn("WHERE", select)
+        self.assertNotIn("LIMIT", select)
+
+
+class GetServiceTest(unittest.TestCase):
+    def test_cache_needs_listen(self):
+        e = self.assertRaises(Exception, getService,
+                              {"servers": SERVERS, "cache_size": "10"})
+        self.assertIn("listen", str(e))
+
+
+class ListingUpdater(object):
+    """ Updater stub recording the listing requests """
+    def __init__(self, work=(), watermark=None):
+        self.work = list(work)
+        self.watermark = watermark
+        self.listed = []
+        self.pages = []
+        self.failing = set()
+        self.changed = []
+        self.listened = 0
+        self.serverManager = MockServerManager(reactor, SERVERS)
+
+    def homeChanged(self, id):
+        self.changed.append(id)
+
+    def listening(self):
+        self.listened += 1
+
+    def getWatermark(self):
+        return defer.succeed(self.watermark)
+
+    def listSharesToUpdate(self, since=None, ids=None, after=None,
+                           limit=None):
+        self.listed.append((since, ids))
+        self.pages.append(after)
+        work = [w for w in self.work if after is None or w[0].id > after]
+        return defer.succeed(work[:limit])
+
+    streamSharesToUpdate = Updater.streamSharesToUpdate.im_func
+    checkStates = Updater.checkStates.im_func
+
+    def updateOne(self, home, status, found=None):
+        if home.id in self.failing:
+            return defer.fail(Exception("Failed"))
+        return defer.succeed(None)
+
+
+class FakeListener(object):
+    def start(self, callback, connected=None):
+        self.callback, self.connected = callback, connected
+
+    def stop(self):
+        self.callback = self.connected = None
+
+
+class ServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.updater = ListingUpdater(watermark=1)
+        self.clock = task.Clock()
+        self.service = UpdaterService(workers=2, full_scan_interval=3600,
+                                      clock=self.clock)
+        self.service.parent = service.MultiService()
+        self.service.parent.updater = self.updater
+        self.service.queue = self.service._makeScheduler(self.updater)
+
+    @defer.inlineCallbacks
+    def test_incremental_scan(self):
+        yield self.service.perform_task()
+        self.assertEquals([(None, None)], self.updater.listed)
+        self.assertEquals(1, self.service.since)
+
+        self.updater.watermark = 2
+        yield self.service.perform_task()
+        self.assertEquals((1, []), self.updater.listed[-1])
+        self.assertEquals(2, self.service.since)
+
+    @defer.inlineCallbacks
+    def test_full_scan_interval(self):
+        yield self.service.perform_task()
+        self.service.last_full_scan -= 3600
+        yield self.service.perform_task()
+        self.assertEquals([(None, None), (None, None)], self.updater.listed)
+
+    @defer.inlineCallbacks
+    def test_retry_failed(self):
+        home = Home()
+        home.id = 42
+        self.updater.work = [(home, [])]
+        self.updater.failing.add(42)
+
+        yield self.service.perform_task()
+        self.assertEquals(set([42]), self.service.retry)
+
+        self.updater.work = []
+        yield self.service.perform_task()
+        self.assertEquals((1, [42]), self.updater.listed[-1])
+        self.assertEquals(set(), self.service.retry)
+
+    @defer.inlineCallbacks
+    def test_listing_failed(self):
+        yield self.service.perform_task()
+        self.service.retry.add(42)
+        self.service.last_full_scan -= 3600
+        listed = self.service.last_full_scan
+
+        self.updater.watermark = 2
+        self.updater.listSharesToUpdate = lambda since=None, ids=None: \
+            defer.fail(Exception("Failed"))
+        yield self.service.perform_task()
+        self.assertEquals(set([42]), self.service.retry)
+        self.assertEquals(listed, self.service.last_full_scan)
+        self.assertEquals(1, self.service.since)
+
+    def test_streamed_scan(self):
+        homes = []
+        for i in xrange(5):
+            home = Home()
+            home.id = i
+            homes.append((home, []))
+        self.updater.work = homes
+
+        running = {}
+        def _updateOne(home, status, found):
+            d = running[home.id] = defer.Deferred()
+            return d
+        self.updater.updateOne = _updateOne
+
+        self.service.batch_size = 2
+        self.service.queue_size = 1
+        self.service.queue = self.service._makeScheduler(self.updater)
+        self.service.perform_task()
+
+        # The second batch waits for room in the queue
+        self.assertEquals([None, 1], self.updater.pages)
+        self.assertEquals(set([0, 1]), set(running))
+
+        # Without holding the next runs, which are skipped meanwhile
+        self.service.perform_task()
+        self.assertEquals([None, 1], self.updater.pages)
+
+        running.pop(0).callback(None)
+        self.assertEquals([None, 1, 3], self.updater.pages)
+        self.assertIs(None, self.service.since)
+
+        running.pop(1).callback(None)
+        self.assertEquals(set([2, 3]), set(running))
+        self.assertEquals(1, self.service.since)
+
+    def test_warm_up(self):
+        connected = defer.Deferred()
+        self.updater.serverManager.warmUp = lambda: connected
+        self.service.warm_up = True
+
+        self.service.startService()
+        self.assertIs(None, self.service.task)
+        self.assertEquals([], self.updater.listed)
+
+        connected.callback({})
+        self.assertEquals([(None, None)], self.updater.listed)
+        self.service.stopService()
+
+    @defer.inlineCallbacks
+    def test_checked_before_queueing(self):
+        home = Home()
+        home.id = 4
+        here, gone = HomeState(), HomeState()
+        for s, name in ((here, "foo"), (gone, "bar")):
+            s.id, s.server_name, s.path, s.status = (4, name, "/test",
+                                                     HomeState.ARCHIVED)
+        foo = yield self.updater.serverManager.getServer("foo")
+        foo.known_paths.add("/data/archive/test")
+        self.updater.work = [(home, [here, gone])]
+
+        updates = []
+        self.updater.updateOne = lambda home, status, found: \
+            updates.append(found)
+        yield self.service.perform_task()
+
+        # Missing paths are left for the update to check again
+        [found] = updates
+        self.assertEquals([(4, "foo")], found.keys())
+
+    def test_listening(self):
+        listings = []
+        def _list(since=None, ids=None):
+            listings.append(defer.Deferred())
+            return listings[-1]
+        self.updater.listSharesToUpdate = _list
+        self.service.listener = FakeListener()
+        self.service.startService()
+        self.assertEquals(1, len(listings))
+
+        # Changes made until then were missed, scanned after the current scan
+        self.service.listener.connected()
+        self.assertEquals(1, self.updater.listened)
+        self.assertEquals(1, len(listings))
+        listings[0].callback([])
+        self.clock.advance(0)
+        self.assertEquals(2, len(listings))
+        self.service.stopService()
+
+    def test_notified_homes(self):
+        self.service.homeChanged("4")
+        self.service.homeChanged("2")
+        self.service.homeChanged("4")
+        self.assertEquals([], self.updater.listed)
+
+        self.clock.advance(1)
+        self.assertEquals([(None, [2, 4])], self.updater.listed)
+        self.assertEquals([4, 2, 4], self.updater.changed)
+        self.assertEquals(set(), self.service.notified)
+
+    def test_notified_while_running(self):
+        home = Home()
+        home.id = 4
+        running = defer.Deferred()
+        self.updater.updateOne = lambda home, status, found: running
+
+        self.service.queue.put((home, []))
+        self.service.homeChanged("4")
+        self.clock.advance(1)
+        self.assertEquals([], self.updater.listed)
+
+        running.callback(None)
+        self.clock.advance(1)
+        self.assertEquals([(None, [4])], self.updater.listed)
+
+    @defer.inlineCallbacks
+    def test_continuous(self):
+        homes = []
+        for i in xrange(3):
+            home = Home()
+            home.id = i
+            homes.append((home, []))
+        self.updater.work = homes
+
+        running = {}
+        def _updateOne(home, status, found):
+            d = running[home.id] = defer.Deferred()
+            return d
+        self.updater.updateOne = _updateOne
+
+        yield self.service.perform_task()
+        self.assertEquals(set([0, 1]), set(running))
+
+        # Scanning again while the first homes are still being updated
+        yield self.service.perform_task()
+        self.assertEquals(1, len(self.service.queue))
+        self.assertEquals(set([0, 1]), self.service.retry)
+
+        running.pop(0).callback(None)
+        self.assertEquals(set([1, 2]), self.service.queue.running)
+
+    def test_backlog(self):
+        homes = []
+        for i in xrange(5):
+            home = Home()
+            home.id = i
+            homes.append((home, []))
+        self.updater.work = homes
+        self.updater.updateOne = lambda home, status, found: defer.Deferred()
+
+        self.service.queue_size = 1
+        self.service.queue = self.service._makeScheduler(self.updater)
+
+        # The scan is done once the homes are handed to the queue
+        self.assertTrue(self.service.perform_task().called)
+        self.assertEquals(2, self.service.queue.active)
+        self.assertEquals(3, len(self.service.queue))
+
+
+class PriorityTest(unittest.TestCase):
+    def _H(self, server_name, path):
+        h = Home()
+        h.server_name, h.path = server_name, path
+        return h
+
+    def _S(self, server_name, status=HomeState.ACTIVE):
+        s = HomeState()
+        s.server_name, s.path, s.status = server_name, "/old", status
+        return s
+
+    def test_classes(self):
+        self.assertEquals(PRIORITY_CREATE,
+                          update_priority(self._H("foo", "/a"), []))
+        self.assertEquals(PRIORITY_MOVE,
+                          update_priority(self._H("foo", "/a"),
+                                          [self._S("foo")]))
+        self.assertEquals(PRIORITY_MIGRATE,
+                          update_priority(self._H("foo", "/a"),
+                                          [self._S("bar")]))
+        self.assertEquals(PRIORITY_ARCHIVE,
+                          update_priority(self._H(None, None),
+                                          [self._S("bar")]))
+
+
+class FlakyServerManager(MockServerManager):
+    """ Fails to connect while C{down}, or to the C{unreachable} servers """
+    down = False
+    unreachable = ()
+
+    def _openConnection(self, name, config):
+        if self.down or name in self.unreachable:
+            return defer.fail(Exception("Connection refused"))
+        return MockServerManager._openConnection(self, name, config)
+
+
+class ReconnectTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sm = FlakyServerManager(self.clock, SERVERS,
+                                     reconnect_delay=10,
+                                     reconnect_max_delay=60)
+
+    def getServer(self, name="foo"):
+        results = []
+        self.sm.getServer(name).addBoth(results.append)
+        return results[0]
+
+    def test_lost_connection(self):
+        su = self.getServer()
+        self.assertIs(su, self.getServer())
+
+        # Evicted once lost, then reconnected right away
+        su.server.lose()
+        self.assertNotIn("foo", self.sm.servers)
+        new = self.getServer()
+        self.assertIsInstance(new, ShareUpdater)
+        self.assertIsNot(su, new)
+
+        # Unless reconnecting fails
+        new.server.lose()
+        self.sm.down = True
+        self.getServer().trap(Exception)
+        self.getServer().trap(ServerUnavailable)
+
+    def test_warm_up(self):
+        self.sm.unreachable = ("bar",)
+        results = self.successResultOf(self.sm.warmUp())
+        self.assertEquals(0, results["foo"])
+        results["bar"].trap(Exception)
+
+        self.assertIn("foo", self.sm.servers)
+        self.getServer("bar").trap(ServerUnavailable)
+
+    def test_idle(self):
+        self.sm.idle_timeout = 60
+        foo = self.getServer("foo")
+        bar = self.getServer("bar")
+        bar.server.idle_since = None
+
+        self.clock.advance(30)
+        self.getServer("foo")
+        self.clock.advance(30)
+        self.assertFalse(foo.server.closed)
+
+        # Idle for a minute, closed then reopened when needed
+        self.clock.advance(30)
+        self.assertTrue(foo.server.closed)
+        self.assertNotIn("foo", self.sm.servers)
+        self.assertIs(bar, self.getServer("bar"))
+        self.assertIsNot(foo, self.getServer("foo"))
+
+    def test_idle_held(self):
+        self.sm.idle_timeout = 60
+        foo = self.getServer("foo")
+        self.sm.hold("foo")
+        self.clock.advance(120)
+        self.assertFalse(foo.server.closed)
+
+        # Idle from its release on
+        self.sm.release("foo")
+        self.clock.advance(30)
+        self.assertFalse(foo.server.closed)
+        self.clock.advance(30)
+        self.assertTrue(foo.server.closed)
+
+    def test_backoff(self):
+        self.sm.down = True
+        delays = []
+        for i in range(5):
+            self.getServer().trap(Exception)
+            delays.append(self.sm._retryAt["foo"] - self.clock.seconds())
+            self.getServer().trap(ServerUnavailable)
+            self.clock.advance(delays[-1])
+
+        for delay, expected in zip(delays, (10, 20, 40, 60, 60)):
+            self.assertTrue(expected / 2.0 <= delay <= expected,
+                            (delay, expected))
+
+        # Back to short delays once connected
+        self.sm.down = False
+        self.getServer().server.lose()
+        self.sm.down = True
+        self.getServer().trap(Exception)
+        self.assertTrue(self.sm._retryAt["foo"] - self.clock.seconds() <= 10)
+
+
+class ShareUpdaterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.server = FakeCommandServer()
+        self.su = ShareUpdater(self.server, SERVERS["foo"], self.clock)
+
+    def test_batched_path_info(self):
+        results = []
+        for path in ("/a", "/b", "/c"):
+            self.su.get_path_info(path).addBoth(results.append)
+        self.assertEquals([], self.server.commands)
+
+        self.clock.advance(1)
+        self.assertEquals(1, len(self.server.commands))
+        command, p = self.server.commands[0]
+        self.assertEquals("/a\n/b\n/c\n", p.input)
+        self.assertEquals(ubuntu.timeout("stat_many"), p.timeout)
+
+        p.dataReceived("ok:directory:user:group:750\nmissing\nerror\n")
+        p.finished.callback(None)
+
+        self.assertEquals({"type": "directory",
+                           "user": "user",
+                           "group": "group",
+                           "mode": 0o750}, results[0])
+        self.assertIs(None, results[1])
+        self.assertIsInstance(results[2], Failure)
+
+    def test_check_statuses(self):
+        states = []
+        for path in ("/a", "/b"):
+            s = HomeState()
+            s.path, s.status = path, HomeState.ACTIVE
+            states.append(s)
+
+        results = []
+        self.su.checkStatuses(states).addCallback(results.append)
+        # Without waiting for more paths to come
+        self.assertEquals(1, len(self.server.commands))
+        command, p = self.server.commands[0]
+        self.assertEquals("/data/homes/a\n/data/homes/b\n", p.input)
+
+        p.dataReceived("missing\nerror\n")
+        p.finished.callback(None)
+        [[(ok_a, info_a), (ok_b, info_b)]] = results
+        self.assertEquals((True, None), (ok_a, info_a))
+        self.assertFalse(ok_b)
+
+    def test_stat_delay(self):
+        su = ShareUpdater(self.server,
+                          Server("foo", "/data/homes", stat_delay="5"),
+                          self.clock)
+        su.get_path_info("/a")
+        self.clock.advance(1)
+        self.assertEquals([], self.server.commands)
+        self.clock.advance(4)
+        self.assertEquals(1, len(self.server.commands))
+
+    def test_rsync_transferred(self):
+        output = "\n".join((
+            "Number of files: 3 (reg: 2, dir: 1)",
+            "Total file size: 12,345,678 bytes",
+            "Total transferred file size: 1,234,567 bytes",
+            "Literal data: 1,234,567 bytes",
+        ))
+        self.assertEquals(1234567, rsync_transferred(output))
+        self.assertIs(None, rsync_transferred(""))
+
+    def test_rsync_progress(self):
+        progress = []
+        p = RsyncProtocol(progress.append)
+        p.dataReceived("        32,768   0%    0.00kB/s    0:00:00")
+        p.dataReceived("\r    10,485,760  50%   1.50MB/s    0:00:07\r")
+        p.dataReceived("    20,971,520 100%    2.00MB/s    0:00:10 (xfr#2)\n")
+        p.dataReceived("\nTotal transferred file size: 20,971,520 bytes\n")
+
+        self.assertEquals([0, 50, 100], [i["percent"] for i in progress])
+        self.assertEquals({"bytes": 10485760, "percent": 50,
+                           "rate": 1572864, "eta": 7}, progress[1])
+        self.assertEquals(20971520, rsync_transferred(p.out.getvalue()))
+
+    def _agentUpdater(self):
+        cfg = Server("foo", "/data/homes", agent="yes")
+        return ShareUpdater(self.server, cfg, self.clock)
+
+    def test_agent(self):
+        su = self._agentUpdater()
+        results = []
+        su.get_path_info("/a").addBoth(results.append)
+        su.exists("/b").addBoth(results.append)
+        self.assertEquals(1, len(self.server.commands))
+        command, p = self.server.commands[0]
+        self.assertEquals(ubuntu.agent, command)
+
+        transport = StringTransport()
+        p.makeConnection(transport)
+        length, source = transport.value().split("\n", 1)
+        self.assertEquals(int(length), len(p.source))
+        requests = [json.loads(line)
+                    for line in source[int(length):].splitlines()]
+        self.assertEquals(["stat", "stat"], [r["op"] for r in requests])
+
+        p.dataReceived("ready\n")
+        p.dataReceived(json.dumps({
+            "id": requests[0]["id"],
+            "result": {"type": "directory", "user": "user",
+                       "group": "group", "mode": 0o750},
+        }) + "\n")
+        p.dataReceived(json.dumps({"id": requests[1]["id"],
+                                   "result": None}) + "\n")
+        self.assertEquals("directory", results[0]["type"])
+        self.assertIs(False, results[1])
+
+    def test_agent_error(self):
+        su = self._agentUpdater()
+        results = []
+        su.get_path_info("/a").addBoth(results.append)
+        command, p = self.server.commands[0]
+        transport = StringTransport()
+        p.makeConnection(transport)
+        length, source = transport.value().split("\n", 1)
+        request = json.loads(source[int(length):])
+
+        p.dataReceived("ready\n")
+        p.dataReceived(json.dumps({"id": request["id"],
+                                   "error": "OSError: denied"}) + "\n")
+        # Not mistaken for a missing path
+        results[0].trap(AgentError)
+
+    def test_agent_timeout(self):
+        su = self._agentUpdater()
+        results = []
+        su.get_path_info("/a").addBoth(results.append)
+        su.get_path_info("/b").addBoth(results.append)
+        command, p = self.server.commands[0]
+        p.makeConnection(StringTransport())
+        p.dataReceived("ready\n")
+
+        # The first request is stuck, the second one uses the command
+        self.clock.advance(ubuntu.timeout("stat"))
+        results.pop(0).trap(CommandTimeout)
+        self.assertTrue(p.transport.disconnecting)
+        self.clock.advance(1)
+        self.assertEquals(2, len(self.server.commands))
+        command, p = self.server.commands[1]
+        self.assertEquals("/b\n", p.input)
+
+        # And the next ones start a new agent
+        su.get_path_info("/c")
+        command, p = self.server.commands[2]
+        self.assertEquals(ubuntu.agent, command)
+
+    def test_agent_idle(self):
+        su = self._agentUpdater()
+        # The agent's channel is the only one open
+        self.server.idleSince = lambda sessions=0: 5 if sessions else None
+        su.get_path_info("/a")
+        command, p = self.server.commands[0]
+        p.makeConnection(StringTransport())
+        length, source = p.transport.value().split("\n", 1)
+        request = json.loads(source[int(length):])
+        p.dataReceived("ready\n")
+        self.assertIs(None, su.idleSince())
+
+        self.clock.advance(10)
+        p.dataReceived(json.dumps({"id": request["id"],
+                                   "result": None}) + "\n")
+        self.assertEquals(10, su.idleSince())
+
+        su.stopAgent()
+        self.assertTrue(p.transport.disconnecting)
+        self.assertIs(None, su.idleSince())
+
+    def test_agent_fallback(self):
+        su = self._agentUpdater()
+        results = []
+        su.get_path_info("/a").addBoth(results.append)
+
+        # The agent can't start, the command is used instead
+        command, p = self.server.commands[0]
+        p.connectionLost(None)
+        self.assertFalse(su.use_agent)
+        self.clock.advance(1)
+        self.assertEquals(2, len(self.server.commands))
+        command, p = self.server.commands[1]
+        self.assertEquals("/a\n", p.input)
+
+        p.dataReceived("missing\n")
+        p.finished.callback(None)
+        self.assertEquals([None], results)
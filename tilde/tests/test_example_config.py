@@ -34,6 +34,10 @@ class LoadTest(unittest.TestCase):
         self.assertEquals("bar", bar.hostname, "Should default to name")
         self.assertEquals("/data/homes", bar.root)
 
+        self.assertEquals(4, foo.max_operations)
+        self.assertEquals(2, foo.max_syncs)
+        self.assertIs(None, bar.max_operations)
+
         self.assertIs(foo.commands, ubuntu)
         self.assertIsNot(bar.commands, ubuntu)
 
@@ -41,3 +45,11 @@ class LoadTest(unittest.TestCase):
         self.assertIn("ubuntu", cmds)
         self.assertIn("custom", cmds)
 
+        self.assertIs(None, cmds["ubuntu"].timeout("sync"))
+        self.assertEquals(86400, cmds["custom"].timeout("sync"))
+        self.assertEquals(60, cmds["custom"].timeout("stat"))
+
+        # Progress is only asked for where rsync is known to support it
+        self.assertNotIn("--info=progress2", cmds["ubuntu"].sync)
+        self.assertIn("--info=progress2", cmds["custom"].sync)
+
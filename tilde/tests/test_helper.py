@@ -0,0 +1,56 @@
+import json
+import os
+import shutil
+import tempfile
+
+from twisted.trial import unittest
+
+from tilde import helper
+
+
+class HelperTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def test_stat(self):
+        os.mkdir(self.path("home"), 0o750)
+        os.chmod(self.path("home"), 0o750)
+        info = helper.do_stat(self.path("home"))
+        self.assertEquals("directory", info["type"])
+        self.assertEquals(0o750, info["mode"])
+        self.assertIs(None, helper.do_stat(self.path("missing")))
+
+        # Only missing paths are None, other errors are raised
+        open(self.path("file"), "w").close()
+        self.assertRaises(OSError, helper.do_stat, self.path("file", "sub"))
+
+    def test_mkdir(self):
+        helper.do_mkdir(self.path("a", "b"))
+        helper.do_mkdir(self.path("a", "b"))
+        self.assertTrue(os.path.isdir(self.path("a", "b")))
+
+    def test_move_backup(self):
+        for name in ("src1", "src2", "dst"):
+            os.mkdir(self.path(name))
+
+        helper.do_move(self.path("src1"), self.path("dst"))
+        helper.do_move(self.path("src2"), self.path("dst"))
+        self.assertEquals(["dst", "dst.~1~", "dst.~2~"],
+                          sorted(os.listdir(self.root)))
+
+    def test_handle(self):
+        response = json.loads(helper.handle(json.dumps({
+            "id": 3, "op": "stat", "args": {"path": self.path("missing")},
+        })))
+        self.assertEquals({"id": 3, "result": None}, response)
+
+        response = json.loads(helper.handle(json.dumps({
+            "id": 4, "op": "unknown", "args": {},
+        })))
+        self.assertEquals(4, response["id"])
+        self.assertIn("error", response)
+        self.assertNotIn("fallback", response)
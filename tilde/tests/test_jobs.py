@@ -0,0 +1,50 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from tilde.jobs import Job, JobConflict, JobManager
+
+
+class JobManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.jobs = JobManager(keep=60, clock=self.clock)
+
+    def test_dedup(self):
+        d = defer.Deferred()
+        job = self.jobs.submit((1, 2), lambda: d, progress=lambda: 50)
+        self.assertIs(job, self.jobs.submit((1, 2), lambda: 1 / 0))
+        self.assertEquals(Job.RUNNING, job.to_json()["state"])
+        self.assertEquals(50, job.to_json()["progress"])
+
+        other = self.jobs.submit((3, 4), lambda: "other")
+        self.assertNotEquals(job.id, other.id)
+        self.assertEquals(Job.DONE, other.state)
+
+        d.callback({"message": "success"})
+        self.assertEquals(Job.DONE, job.state)
+        self.assertEquals({"message": "success"}, job.result)
+        self.assertIsNot(job, self.jobs.submit((1, 2), lambda: None))
+
+    def test_conflict(self):
+        d = defer.Deferred()
+        job = self.jobs.submit((1, 2), lambda: d)
+        for keys in ((1, 3), (2, 1), (3, 2)):
+            e = self.assertRaises(JobConflict, self.jobs.submit, keys,
+                                  lambda: None)
+            self.assertIs(job, e.job)
+
+        d.callback(None)
+        self.assertEquals(Job.DONE, self.jobs.submit((2, 1), lambda: 1).state)
+
+    def test_failed(self):
+        job = self.jobs.submit(["key"], lambda: defer.fail(Exception("Oops")))
+        self.assertEquals(Job.FAILED, job.state)
+        self.assertEquals("Oops", job.error)
+        self.flushLoggedErrors()
+
+    def test_expiry(self):
+        job = self.jobs.submit(["key"], lambda: None)
+        self.clock.advance(59)
+        self.assertIs(job, self.jobs.get(job.id))
+        self.clock.advance(1)
+        self.assertIs(None, self.jobs.get(job.id))
@@ -0,0 +1,248 @@
+import json
+from StringIO import StringIO
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.web import http
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.requesthelper import DummyRequest
+
+from tilde.models import Home
+from tilde.jobs import JobManager
+from tilde.rest import HomeList, HomeResource, JobResource, Lookup, Merge
+
+
+class FakeService(object):
+    """ Serves homes from a list, like Updater would from the database """
+    def __init__(self, homes):
+        self.homes = homes
+        self.queries = []
+
+    def listHomes(self, after=None, limit=1000, server_name=None,
+                  status=None):
+        self.queries.append((after, limit, server_name, status))
+        return defer.succeed([h for h in self.homes
+                              if after is None or h.id > after][:limit])
+
+
+def makeHome(id):
+    home = Home()
+    home.id = id
+    home.server_name = u"foo"
+    home.path = u"/home{0}".format(id)
+    return home
+
+
+class StreamRequest(DummyRequest):
+    """ Keeps the push producer registered, instead of pulling from it """
+    producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+class HomeListTest(unittest.TestCase):
+    def setUp(self):
+        self.service = FakeService([makeHome(i) for i in range(1, 8)])
+        self.resource = HomeList(self.service)
+        self.resource.page_size = 3
+
+    def get(self, **args):
+        request = StreamRequest([])
+        request.args = dict((k, [str(v)]) for k, v in args.iteritems())
+        self.resource.render_GET(request)
+        self.assertEquals(1, request.finished)
+        return request, json.loads("".join(request.written))
+
+    def test_all(self):
+        request, result = self.get()
+        self.assertEquals(range(1, 8), [h["id"] for h in result["homes"]])
+        self.assertIs(None, result["next"])
+        # Written a page at a time
+        self.assertEquals([None, 3, 6], [q[0] for q in self.service.queries])
+
+    def test_pages(self):
+        request, result = self.get(limit=4, server_name="foo")
+        self.assertEquals([1, 2, 3, 4], [h["id"] for h in result["homes"]])
+        self.assertEquals(4, result["next"])
+        self.assertEquals((3, 2, u"foo", None), self.service.queries[-1])
+
+        request, result = self.get(after=4, limit=4)
+        self.assertEquals([5, 6, 7], [h["id"] for h in result["homes"]])
+        self.assertIs(None, result["next"])
+
+        # Ending right on the last home
+        request, result = self.get(after=4, limit=3)
+        self.assertEquals([5, 6, 7], [h["id"] for h in result["homes"]])
+        self.assertIs(None, result["next"])
+
+    def test_slow_client(self):
+        request = StreamRequest([])
+        request.args = {}
+        producers = []
+        write = request.write
+        def _write(data):
+            # Each page fills up the transport's buffer
+            write(data)
+            if request.producer is not None:
+                producers.append(request.producer)
+                request.producer.pauseProducing()
+        request.write = _write
+
+        self.resource.render_GET(request)
+        self.assertEquals([None], [q[0] for q in self.service.queries])
+        producers[-1].resumeProducing()
+        self.assertEquals([None, 3], [q[0] for q in self.service.queries])
+        producers[-1].resumeProducing()
+        self.assertEquals(1, request.finished)
+        self.assertIs(None, request.producer)
+        result = json.loads("".join(request.written))
+        self.assertEquals(range(1, 8), [h["id"] for h in result["homes"]])
+
+    def test_bad_args(self):
+        request = DummyRequest([])
+        request.args = {"after": ["x"]}
+        self.resource.render_GET(request)
+        self.assertEquals(400, request.responseCode)
+
+        request = DummyRequest([])
+        request.args = {"limit": ["-1"]}
+        self.resource.render_GET(request)
+        self.assertEquals(400, request.responseCode)
+
+
+class LookupService(object):
+    def __init__(self, homes):
+        self.homes = homes
+
+    def lookupHomes(self, ids=(), uuids=(), states=False):
+        found = [h for h in self.homes if h.id in ids]
+        if states:
+            found = [(h, []) for h in found]
+        return defer.succeed(found)
+
+
+class LookupTest(unittest.TestCase):
+    def setUp(self):
+        self.resource = Lookup(LookupService([makeHome(1), makeHome(2)]))
+
+    def post(self, query):
+        request = DummyRequest([])
+        request.method = "POST"
+        request.content = StringIO(query)
+        result = self.resource.render_POST(request)
+        if result != NOT_DONE_YET:
+            request.write(result)
+        return request, json.loads("".join(request.written))
+
+    def test_lookup(self):
+        request, result = self.post(json.dumps({"ids": [2, 3]}))
+        self.assertEquals([2], [h["id"] for h in result["homes"]])
+
+        request, result = self.post(json.dumps({"ids": [1], "states": True}))
+        self.assertEquals([], result["homes"][0]["states"])
+
+    def test_bad_query(self):
+        request, result = self.post(json.dumps({"ids": ["x"]}))
+        self.assertEquals(400, request.responseCode)
+        request, result = self.post("[]")
+        self.assertEquals(400, request.responseCode)
+        request, result = self.post(json.dumps({"uuids": "abc"}))
+        self.assertEquals(400, request.responseCode)
+
+
+class ConditionalRequest(DummyRequest):
+    """ DummyRequest answering conditional requests like a real one """
+    setETag = http.Request.setETag.im_func
+
+
+class FindService(object):
+    def __init__(self, homes):
+        self.homes = homes
+
+    def findHome(self, *condition):
+        return defer.succeed([h.copy() for h in self.homes])
+
+
+class HomeResourceTest(unittest.TestCase):
+    def setUp(self):
+        self.service = FindService([makeHome(1)])
+        self.resource = HomeResource(self.service, (Home.id == 1,))
+
+    def get(self, etag=None):
+        request = ConditionalRequest([])
+        if etag is not None:
+            request.requestHeaders.setRawHeaders("if-none-match", [etag])
+        self.resource.render_GET(request)
+        self.assertEquals(1, request.finished)
+        return request
+
+    def test_etag(self):
+        request = self.get()
+        etag = request.etag
+        self.assertEquals(1, len(json.loads("".join(request.written))["homes"]))
+
+        request = self.get(etag)
+        self.assertEquals(http.NOT_MODIFIED, request.responseCode)
+        self.assertEquals([], request.written)
+
+        # Moved without anything else changing
+        self.service.homes[0].path = u"/moved"
+        request = self.get(etag)
+        self.assertNotEquals(etag, request.etag)
+        self.assertEquals(u"/moved", json.loads("".join(request.written))
+                                         ["homes"][0]["path"])
+
+    def test_not_found(self):
+        self.service.homes = []
+        request = self.get()
+        self.assertIs(None, getattr(request, "etag", None))
+        self.assertEquals([], json.loads("".join(request.written))["homes"])
+
+
+class MergeRequest(DummyRequest):
+    def prePathURL(self):
+        return "http://localhost:8080/" + "/".join(self.prepath)
+
+
+class MergeTest(unittest.TestCase):
+    def setUp(self):
+        self.jobs = JobManager(clock=task.Clock())
+        self.service = FakeService([])
+        self.service.transfers = {}
+        self.resource = Merge(self.service, self.jobs)
+        self.merging = defer.Deferred()
+        self.resource.getHomes = lambda source, dest: self.merging
+        self.resource.merge = lambda homes, path: {"message": "success"}
+
+    def post(self, **args):
+        request = MergeRequest([])
+        request.prepath = ["api", "merge"]
+        request.method = "POST"
+        request.args = dict((k, [str(v)]) for k, v in args.iteritems())
+        return request, json.loads(self.resource.render_POST(request))
+
+    def test_job(self):
+        request, result = self.post(source_id=1, dest_id=2)
+        self.assertEquals(202, request.responseCode)
+        self.assertEquals(
+            ["http://localhost:8080/api/jobs/{0}".format(result["job"])],
+            request.responseHeaders.getRawHeaders("location"))
+        job = self.jobs.get(result["job"])
+        self.assertEquals("running", job.state)
+
+        # Asking again while it runs gives the same job
+        request, again = self.post(source_id=1, dest_id=2)
+        self.assertEquals(result, again)
+
+        # Either home can't be merged elsewhere meanwhile
+        request, conflict = self.post(source_id=2, dest_id=1)
+        self.assertEquals(409, request.responseCode)
+        self.assertEquals(result["job"], conflict["job"])
+
+        self.merging.callback({})
+        status = JobResource(job).render_GET(DummyRequest([]))
+        self.assertEquals({"message": "success"}, json.loads(status)["result"])
@@ -0,0 +1,175 @@
+from __future__ import unicode_literals
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from tilde.scheduler import Scheduler
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.running = {}
+        self.clock = task.Clock()
+        self.scheduler = Scheduler(self.process, workers=2, size=2,
+                                   clock=self.clock)
+
+    def process(self, name):
+        d = self.running[name] = defer.Deferred()
+        return d
+
+    def finish(self, name):
+        self.running.pop(name).callback(None)
+
+    def test_workers(self):
+        for name in "abc":
+            self.scheduler.put((name,))
+
+        self.assertEquals(set("ab"), set(self.running))
+        self.finish("a")
+        self.assertEquals(set("bc"), set(self.running))
+
+    def test_backpressure(self):
+        accepted = [self.scheduler.put((name,)) for name in "abcde"]
+        self.assertEquals([True, True, True, True, False],
+                          [d.called for d in accepted])
+
+        self.finish("a")
+        self.assertTrue(accepted[-1].called)
+
+    def test_done(self):
+        self.scheduler.putAll([(name,) for name in "abc"])
+        done = self.scheduler.whenDone()
+        self.scheduler.close()
+
+        self.finish("a")
+        self.finish("b")
+        self.assertFalse(done.called)
+        self.finish("c")
+        self.assertTrue(done.called)
+
+    def test_limits(self):
+        limits = {"foo": 1, ("foo", "bar"): 1}
+        scheduler = Scheduler(self.process, workers=3, size=10,
+                              keys=lambda name: name.split("-"),
+                              limit=limits.get,
+                              clock=self.clock)
+
+        scheduler.putAll([("foo-a",), ("foo-b",), ("bar-c",), ("bar-d",)])
+        self.assertEquals(set(["foo-a", "bar-c", "bar-d"]),
+                          set(self.running))
+
+        self.finish("foo-a")
+        self.assertIn("foo-b", self.running)
+        self.assertEquals(1, scheduler.busy["foo"])
+        self.assertEquals(2, scheduler.busy["bar"])
+
+    def test_limits_waiting(self):
+        limits = {"foo": 1}
+        scheduler = Scheduler(self.process, workers=2, size=1,
+                              keys=lambda name: name.split("-"),
+                              limit=limits.get,
+                              clock=self.clock)
+
+        accepted = scheduler.putAll([("foo-a",), ("foo-b",), ("bar-c",),
+                                     ("foo-d",)])
+        self.assertEquals(set(["foo-a", "bar-c"]), set(self.running))
+        self.assertFalse(accepted.called)
+
+        self.finish("foo-a")
+        self.assertEquals(set(["foo-b", "bar-c"]), set(self.running))
+        self.assertTrue(accepted.called)
+
+    def test_waiting_by_keys(self):
+        limits = {"foo": 1}
+        scheduler = Scheduler(self.process, workers=2, size=1,
+                              keys=lambda name: name.split("-")[:1],
+                              limit=limits.get,
+                              clock=self.clock)
+
+        scheduler.putAll([("foo-{0}".format(i),) for i in xrange(1000)] +
+                         [("bar-a",)])
+        self.assertEquals(set(["foo-0", "bar-a"]), set(self.running))
+        # Waiting items are only looked at by group, not one by one
+        self.assertEquals(1, len(scheduler._putters.groups))
+
+        self.finish("foo-0")
+        self.assertEquals(set(["foo-1", "bar-a"]), set(self.running))
+
+    def test_priority(self):
+        priorities = {"create": 0, "archive": 3}
+        scheduler = Scheduler(self.process, workers=1, size=10,
+                              priority=lambda n: priorities.get(n, 1),
+                              aging=60,
+                              clock=self.clock)
+
+        scheduler.put(("first",))
+        scheduler.put(("archive",))
+        self.clock.advance(10)
+        scheduler.put(("create",))
+
+        self.finish("first")
+        self.assertEquals(["create"], self.running.keys())
+
+    def test_aging(self):
+        priorities = {"create": 0, "archive": 3}
+        scheduler = Scheduler(self.process, workers=1, size=10,
+                              priority=lambda n: priorities.get(n, 1),
+                              aging=60,
+                              clock=self.clock)
+
+        scheduler.put(("first",))
+        scheduler.put(("archive",))
+        self.clock.advance(200)
+        scheduler.put(("create",))
+
+        self.finish("first")
+        self.assertEquals(["archive"], self.running.keys())
+
+    def test_waiting_priority(self):
+        priorities = {"create": 0, "archive": 3}
+        scheduler = Scheduler(self.process, workers=1, size=1,
+                              priority=lambda n: priorities[n.split("-")[0]],
+                              aging=60,
+                              clock=self.clock)
+
+        scheduler.put(("archive-1",))
+        scheduler.put(("archive-2",))
+        archive = scheduler.put(("archive-3",))
+        self.clock.advance(100)
+        create = scheduler.put(("create-1",))
+
+        self.finish("archive-1")
+        self.assertTrue(create.called)
+        self.assertFalse(archive.called)
+
+        # Waiting archives age too
+        self.clock.advance(100)
+        create = scheduler.put(("create-2",))
+        self.finish("archive-2")
+        self.assertTrue(archive.called)
+        self.assertFalse(create.called)
+
+    def test_refresh_priority(self):
+        scheduler = Scheduler(lambda name, priority: self.process(name),
+                              workers=1, size=10,
+                              priority=lambda name, priority: priority,
+                              ident=lambda name, priority: name,
+                              clock=self.clock)
+
+        scheduler.put(("first", 0))
+        scheduler.put(("a", 3))
+        scheduler.put(("b", 1))
+        scheduler.put(("a", 0))
+        self.assertEquals(2, len(scheduler))
+
+        self.finish("first")
+        self.assertEquals(["a"], self.running.keys())
+
+    def test_synchronous(self):
+        processed = []
+        scheduler = Scheduler(processed.append, workers=1, size=10,
+                              clock=self.clock)
+        scheduler.putAll([(i,) for i in xrange(5000)])
+        scheduler.close()
+        self.assertEquals(range(5000), processed)
+        self.assertTrue(scheduler.whenDone().called)
@@ -0,0 +1,210 @@
+import struct
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.internet.error import ConnectionLost
+from twisted.internet.protocol import Factory
+from twisted.python.failure import Failure
+from twisted.conch.ssh.common import NS
+
+from tilde.ssh import (
+    SSHServer,
+    SSHServerPool,
+    SSHTransport,
+    RunCommandProtocol,
+    CommandTimeout,
+    CaptureBuffer,
+    _CommandChannel,
+    _makeProtocol,
+)
+
+
+class FakeMember(object):
+    """ Records channels instead of opening them """
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.channels = []
+        self.closed = False
+        self._lostCallbacks = []
+
+    def connect(self):
+        if self.fail:
+            return defer.fail(Exception("Connection refused"))
+        return defer.succeed(self)
+
+    def notifyOnLost(self, callback):
+        self._lostCallbacks.append(callback)
+
+    def lose(self):
+        for callback in self._lostCallbacks:
+            callback(ConnectionLost())
+
+    def loseConnection(self):
+        self.closed = True
+
+    def _runCommand(self, command, p, onClose=None, timeout=None):
+        self.channels.append((command, p, onClose))
+
+
+class PoolTest(unittest.TestCase):
+    def makePool(self, *members, **kw):
+        pool = SSHServerPool(task.Clock(), user="root",
+                             connections=len(members), **kw)
+        pool.members = list(members)
+        pool.sessions = dict((member, 0) for member in members)
+        results = []
+        pool.connect().addBoth(results.append)
+        return pool, results[0]
+
+    def test_least_loaded(self):
+        a, b = FakeMember(), FakeMember()
+        pool, result = self.makePool(a, b, max_sessions=2)
+        self.assertIs(pool, result)
+
+        for i in range(5):
+            pool.runCommand("cmd{0}".format(i), RunCommandProtocol)
+        self.assertEquals(2, len(a.channels))
+        self.assertEquals(2, len(b.channels))
+        self.assertEquals(1, len(pool._waiting))
+
+        # The waiting command goes to the first connection with room
+        command, p, onClose = b.channels[0]
+        onClose()
+        onClose()
+        self.assertEquals(3, len(b.channels))
+        self.assertEquals("cmd4", b.channels[-1][0])
+        self.assertEquals({a: 2, b: 2}, pool.sessions)
+        self.assertIs(None, pool.idleSince())
+
+        for member in a, b:
+            for command, p, onClose in member.channels:
+                onClose()
+        self.assertEquals(0, pool.idleSince())
+
+    def test_idle_kept_sessions(self):
+        a = FakeMember()
+        pool, result = self.makePool(a)
+        pool.runCommand("agent", RunCommandProtocol)
+        self.assertIs(None, pool.idleSince())
+        self.assertEquals(0, pool.idleSince(sessions=1))
+
+    def test_partial_connect(self):
+        a, b = FakeMember(), FakeMember(fail=True)
+        pool, result = self.makePool(a, b)
+        self.assertIs(pool, result)
+        self.assertEquals([a], pool.members)
+
+        pool, result = self.makePool(FakeMember(fail=True))
+        result.trap(Exception)
+
+    def test_lost(self):
+        a, b = FakeMember(), FakeMember()
+        pool, result = self.makePool(a, b, max_sessions=1)
+        lost = []
+        pool.notifyOnLost(lost.append)
+
+        pool.runCommand("cmd1", RunCommandProtocol)
+        pool.runCommand("cmd2", RunCommandProtocol)
+        waiting = pool.runCommand("cmd3", RunCommandProtocol)
+
+        # Reported once, and the other connection closes when idle
+        a.lose()
+        self.assertEquals(1, len(lost))
+        self.assertFalse(b.closed)
+        b.channels[0][2]()
+        self.assertEquals("cmd3", b.channels[-1][0])
+        b.channels[-1][2]()
+        self.assertTrue(b.closed)
+
+        b.lose()
+        self.assertEquals(1, len(lost))
+        self.failureResultOf(
+            pool.runCommand("cmd4", RunCommandProtocol).finished,
+            ConnectionLost)
+
+
+class FakeConnection(object):
+    """ Records channel requests """
+    def __init__(self, clock):
+        self.factory = Factory()
+        self.factory.server = SSHServer(clock, user="root")
+        self.requests = []
+
+    def sendRequest(self, channel, request, data, wantReply=0):
+        self.requests.append(request)
+
+    def sendClose(self, channel):
+        self.requests.append("close")
+
+
+class TimeoutTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.conn = FakeConnection(self.clock)
+
+    def openChannel(self, timeout):
+        p = _makeProtocol(RunCommandProtocol)
+        channel = _CommandChannel("sleep 60", p, timeout=timeout)
+        channel.conn = self.conn
+        channel.channelOpen(None)
+        return channel, p
+
+    def test_timeout(self):
+        channel, p = self.openChannel(10)
+        self.clock.advance(9)
+        self.assertNoResult(p.finished)
+
+        self.clock.advance(1)
+        self.failureResultOf(p.finished, CommandTimeout)
+        self.assertEquals(["exec", "signal", "close"], self.conn.requests)
+
+        # The exit status of the killed command comes too late
+        channel.request_exit_signal(NS("KILL") + "\0" + NS("") + NS(""))
+
+    def test_completed(self):
+        channel, p = self.openChannel(10)
+        channel.request_exit_status(struct.pack(">L", 0))
+        self.successResultOf(p.finished)
+        self.assertEquals([], self.clock.getDelayedCalls())
+
+
+class CaptureTest(unittest.TestCase):
+    def test_unbounded(self):
+        out = CaptureBuffer()
+        for i in range(100):
+            out.write("line {0}\n".format(i))
+        self.assertEquals(100, len(out.getvalue().splitlines()))
+        self.assertEquals(len(out.getvalue()), out.written)
+
+    def test_head_and_tail(self):
+        out = CaptureBuffer(20)
+        out.write("first line\n")
+        for i in range(1000):
+            out.write("x" * 10)
+        out.write("\nlast line\n")
+
+        self.assertEquals(11 + 10000 + 11, out.written)
+        value = out.getvalue()
+        self.assertTrue(value.startswith("first line"), value)
+        self.assertTrue(value.endswith("\nlast line\n"), value)
+        self.assertIn("[... 10002 bytes skipped ...]", value)
+        self.assertTrue(len(out._tail) <= 2)
+
+    def test_small(self):
+        out = CaptureBuffer(20)
+        out.write("short\n")
+        out.write("output\n")
+        self.assertEquals("short\noutput\n", out.getvalue())
+
+
+class TransportTest(unittest.TestCase):
+    def test_lost_after_key_exchange(self):
+        transport = SSHTransport()
+        transport.factory = Factory()
+        transport.factory.serverConnected = defer.Deferred()
+        transport._secured = True
+
+        # Before the connection service started
+        transport.connectionLost(Failure(ConnectionLost()))
+        self.failureResultOf(transport.factory.serverConnected,
+                             ConnectionLost)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+# (C) Copyright Révolution Linux 2012
+#
+# Authors:
+# Vincent Vinet <vince.vinet@gmail.com>
+#
+# This file is part of tilde.
+#
+# tilde is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tilde is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tilde.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import unicode_literals
+
+import collections
+import logging
+log = logging.getLogger(__name__)
+
+from zope.component import getUtility
+
+from storm.zope.zstorm import IZStorm
+from storm.expr import And, Or
+
+from twisted.internet import defer
+
+from tilde.models import Home, HomeState
+
+
+UPDATE_STATE = "update_state"
+DELETE_STATE = "delete_state"
+DELETE_HOME = "delete_home"
+
+
+class StateWriter(object):
+    """ Groups state writes issued within C{delay} seconds in one transaction
+
+    Up to C{size} writes are committed together, with set-based deletes. The
+    C{Deferred} returned for each write fires once it has been committed.
+    When a batch fails, its writes are retried one by one so only the
+    faulty ones fail.
+    """
+
+    def __init__(self, transactor, delay=0.05, size=100, clock=None):
+        self.transactor = transactor
+        self.delay = delay
+        self.size = max(size, 1)
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+
+        self._ops = []
+        self._flushCall = None
+
+    def updateState(self, homestate):
+        return self._queue(UPDATE_STATE, HomeState.fromState(homestate))
+
+    def deleteState(self, homestate):
+        return self._queue(DELETE_STATE, HomeState.fromState(homestate))
+
+    def deleteHome(self, home):
+        return self._queue(DELETE_HOME, home.id)
+
+    def _queue(self, kind, value):
+        d = defer.Deferred()
+        self._ops.append((kind, value, d))
+        if len(self._ops) >= self.size:
+            self.flush()
+        elif self._flushCall is None:
+            self._flushCall = self.clock.callLater(self.delay, self.flush)
+        return d
+
+    def flush(self):
+        """ Write everything queued so far """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+
+        ops, self._ops = self._ops, []
+        if ops:
+            self._run(ops)
+
+    def _run(self, ops):
+        d = self.transactor.run(self._write, [op[:2] for op in ops])
+        d.addCallbacks(self._written, self._failed,
+                       callbackArgs=(ops,), errbackArgs=(ops,))
+
+    def _written(self, result, ops):
+        for kind, value, d in ops:
+            d.callback(None)
+
+    def _failed(self, reason, ops):
+        if len(ops) == 1:
+            ops[0][2].errback(reason)
+            return
+
+        log.warning("Failed to write %d changes at once, retrying them one "
+                    "by one: %s", len(ops), reason.getErrorMessage())
+        for op in ops:
+            self._run([op])
+
+    def _write(self, ops):
+        """ Apply C{ops} in the transactor thread, the last write wins """
+        zs = getUtility(IZStorm).get("tilde")
+
+        states = collections.OrderedDict()
+        homes = []
+        for kind, value in ops:
+            if kind == DELETE_HOME:
+                homes.append(value)
+                for key in [k for k in states if k[0] == value]:
+                    del states[key]
+            else:
+                states[(value.id, value.server_name)] = (kind, value)
+
+        deleted = [key for key, (kind, value) in states.iteritems()
+                   if kind == DELETE_STATE]
+        if deleted:
+            zs.find(HomeState, self._stateKeys(deleted)).remove()
+
+        updated = dict((key, value)
+                       for key, (kind, value) in states.iteritems()
+                       if kind == UPDATE_STATE)
+        if updated:
+            for hs in zs.find(HomeState, self._stateKeys(updated)):
+                hs.update(updated.pop((hs.id, hs.server_name)))
+            for value in updated.itervalues():
+                zs.add(HomeState.fromState(value))
+
+        if homes:
+            zs.find(HomeState, HomeState.id.is_in(homes)).remove()
+            zs.find(Home, Home.id.is_in(homes)).remove()
+
+    def _stateKeys(self, keys):
+        return Or(*[And(HomeState.id == id, HomeState.server_name == name)
+                    for id, name in keys])